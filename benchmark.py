@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+
+import os, sys, io, time, random, tarfile, resource, multiprocessing
+from os.path import isfile, isdir, join
+import gutenberg
+
+help_string = """\
+Use:
+python benchmark.py book_count [work_dir] [seed]
+
+Builds a synthetic rdf-files.tar.bz2 with book_count ebooks in work_dir
+(default bench/, reused if the count and seed match) and times each
+stage of gutenberg.py against it.  Every stage runs in its own process
+so the peak RSS column belongs to that stage alone.
+
+The corpus covers the shapes the real feed throws at us: several
+creators, aliases and webpages, a lone dcterms:hasFormat, multiple
+formats per file, no files at all (de-listed), missing titles, missing
+creators and odd bookshelf/subject counts.
+"""
+
+# -- synthetic corpus --
+
+rdf_head = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xml:base="http://www.gutenberg.org/"
+  xmlns:cc="http://web.resource.org/cc/"
+  xmlns:dcam="http://purl.org/dc/dcam/"
+  xmlns:dcterms="http://purl.org/dc/terms/"
+  xmlns:marcrel="http://id.loc.gov/vocabulary/relators/"
+  xmlns:pgterms="http://www.gutenberg.org/2009/pgterms/"
+  xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+  xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+>
+"""
+
+formats = ['application/zip', 'text/html; charset=utf-8', 'text/html',
+           'text/html; charset=iso-8859-1', 'text/plain', 'text/plain; charset=us-ascii',
+           'text/plain; charset=utf-8', 'application/epub+zip',
+           'application/x-mobipocket-ebook', 'application/rdf+xml', 'image/jpeg']
+rights = ['Public domain in the USA.',
+          'Copyrighted. Read the copyright notice inside this book for details.']
+languages = ['en'] * 8 + ['fr', 'de', 'it', 'fi', 'nl', 'es', 'pt', 'zh']
+media_types = ['Text'] * 12 + ['Sound', 'Image', 'StillImage', 'Dataset']
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+def described(tag, value, member=None, datatype=None):
+    "the <tag><rdf:Description><rdf:value> sandwich"
+    m = ''
+    if member:
+        m = '<dcam:memberOf rdf:resource="%s"/>\n' % member
+    d = ''
+    if datatype:
+        d = ' rdf:datatype="%s"' % datatype
+    return ('<%s>\n<rdf:Description rdf:nodeID="N%x">\n%s<rdf:value%s>%s</rdf:value>\n'
+            '</rdf:Description>\n</%s>\n' % (tag, random.getrandbits(64), m, d, value, tag))
+
+def fake_agent(r):
+    n = r.randint(1, 30000)
+    out = ['<dcterms:creator>\n<pgterms:agent rdf:about="2009/agents/%i">\n' % n]
+    out.append('<pgterms:name>Surname%i, Given &amp; Co.</pgterms:name>\n' % n)
+    if r.random() < 0.7:
+        born = r.randint(1400, 1950)
+        out.append('<pgterms:birthdate rdf:datatype="%sinteger">%i</pgterms:birthdate>\n' % (XSD, born))
+        if r.random() < 0.8:
+            out.append('<pgterms:deathdate rdf:datatype="%sinteger">%i</pgterms:deathdate>\n' % (XSD, born + r.randint(20, 90)))
+    for a in range(r.choice([0, 0, 0, 1, 2])):
+        out.append('<pgterms:alias>Alias %i-%i</pgterms:alias>\n' % (n, a))
+    for w in range(r.choice([0, 1, 1, 2])):
+        out.append('<pgterms:webpage rdf:resource="http://en.wikipedia.org/wiki/Author_%i_%i"/>\n' % (n, w))
+    out.append('</pgterms:agent>\n</dcterms:creator>\n')
+    return ''.join(out)
+
+def fake_file(r, num):
+    ext = r.choice(['zip', 'txt', 'htm', 'epub'])
+    out = ['<dcterms:hasFormat>\n<pgterms:file rdf:about="http://www.gutenberg.org/files/%i/%i-%i.%s">\n' % (num, num, r.randint(0, 8), ext)]
+    out.append('<dcterms:extent rdf:datatype="%sinteger">%i</dcterms:extent>\n' % (XSD, r.randint(2000, 8000000)))
+    for f in r.sample(formats, r.choice([1, 1, 1, 2])):
+        out.append(described('dcterms:format', f, 'http://purl.org/dc/terms/IMT', 'http://purl.org/dc/terms/IMT'))
+    out.append('<dcterms:modified rdf:datatype="%sdateTime">20%02i-%02i-%02iT12:00:00</dcterms:modified>\n'
+               % (XSD, r.randint(5, 16), r.randint(1, 12), r.randint(1, 28)))
+    out.append('<dcterms:isFormatOf rdf:resource="ebooks/%i"/>\n' % num)
+    out.append('</pgterms:file>\n</dcterms:hasFormat>\n')
+    return ''.join(out)
+
+def fake_rdf(r, num):
+    "one rdf file as bytes"
+    out = [rdf_head, '<pgterms:ebook rdf:about="ebooks/%i">\n' % num]
+    out.append('<dcterms:publisher>Project Gutenberg</dcterms:publisher>\n')
+    out.append('<dcterms:license rdf:resource="license"/>\n')
+    out.append('<dcterms:issued rdf:datatype="%sdate">%i-%02i-01</dcterms:issued>\n'
+               % (XSD, r.randint(1971, 2015), r.randint(1, 12)))
+    out.append('<dcterms:rights>%s</dcterms:rights>\n' % r.choice(rights))
+    out.append('<pgterms:downloads rdf:datatype="%sinteger">%i</pgterms:downloads>\n'
+               % (XSD, int(r.paretovariate(1.2) * 10)))
+    if r.random() > 0.01:
+        out.append('<dcterms:title>Volume %i: the &lt;Synthetic&gt; History\nof Book %i</dcterms:title>\n' % (r.randint(1, 9), num))
+    for l in range(r.choice([1] * 30 + [2])):
+        out.append(described('dcterms:language', r.choice(languages), None, 'http://purl.org/dc/terms/RFC4646'))
+    for c in range(r.choice([0, 1, 1, 1, 1, 2, 3])):
+        out.append(fake_agent(r))
+    for s in range(r.choice([0, 1, 2, 3, 4])):
+        out.append(described('dcterms:subject', 'Subject %i -- Fiction' % r.randint(0, 3000), 'http://purl.org/dc/terms/LCSH'))
+    if r.random() < 0.01:
+        files = 0
+    elif r.random() < 0.03:
+        files = 1  # printed as 'weird files'
+    else:
+        files = r.randint(3, 14)
+    for f in range(files):
+        out.append(fake_file(r, num))
+    for b in range(r.choice([0, 0, 0, 1, 2])):
+        out.append(described('pgterms:bookshelf', 'Bookshelf %i' % r.randint(0, 200), '2009/pgterms/Bookshelf'))
+    out.append(described('dcterms:type', r.choice(media_types), 'http://purl.org/dc/terms/DCMIType'))
+    out.append('</pgterms:ebook>\n')
+    out.append('<cc:Work rdf:about="">\n<cc:license rdf:resource="https://www.gnu.org/licenses/gpl.html"/>\n</cc:Work>\n')
+    out.append('</rdf:RDF>\n')
+    return ''.join(out).encode('utf-8')
+
+def make_corpus(path, count, seed=0):
+    "writes a synthetic rdf-files.tar.bz2 laid out like the real feed"
+    r = random.Random(seed)
+    random.seed(seed)
+    t = tarfile.open(path, 'w:bz2')
+    for num in range(1, count + 1):
+        data = fake_rdf(r, num)
+        info = tarfile.TarInfo('cache/epub/%i/pg%i.rdf' % (num, num))
+        info.size = len(data)
+        info.mtime = 1420070400 + num
+        t.addfile(info, io.BytesIO(data))
+    t.close()
+
+# -- stages --
+
+def count_iterator(work):
+    n = 0
+    size = 0
+    rdf = gutenberg.open_rdf()
+    for m, xml in gutenberg.rdf_iterator(rdf):
+        n += 1
+        size += len(xml)
+    rdf.close()
+    return n, size
+
+def count_metadata(work):
+    rdf = gutenberg.open_rdf()
+    n = sum(1 for _ in gutenberg.metadata(rdf))
+    rdf.close()
+    return n, None
+
+def count_xmltodict(work):
+    rdf = gutenberg.open_rdf()
+    n = sum(1 for _ in gutenberg.metadata_xmltodict(rdf))
+    rdf.close()
+    return n, None
+
+def run_json_metadata(output):
+    def stage(work):
+        sys.argv = ['gutenberg.py', output]
+        gutenberg.json_metadata()
+        return None, os.path.getsize(output)
+    return stage
+
+def run_popular(catalog=None):
+    def stage(work):
+        return len(gutenberg.popular_books(2000, catalog)), None
+    return stage
+
+def run_load(catalog):
+    def stage(work):
+        pg = gutenberg.load_catalog(catalog)
+        # a Catalog is lazy, touch the popular end like pg2zb would
+        if isinstance(pg, gutenberg.Catalog):
+            return len(pg.top(2000)), os.path.getsize(catalog)
+        return len(pg), os.path.getsize(catalog)
+    return stage
+
+def child(fn, work, queue):
+    os.chdir(work)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t = time.time()
+        items, size = fn(work)
+        elapsed = time.time() - t
+        # kilobytes on linux, bytes on osx
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((elapsed, items, size, rss, None))
+    except Exception as e:
+        queue.put((None, None, None, None, repr(e)))
+
+def measure(fn, work):
+    "(seconds, items, bytes, peak rss kB, error) for one stage in a fresh process"
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=child, args=(fn, work, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+def stages(count):
+    out = [('rdf_iterator', count_iterator),
+           ('metadata', count_metadata)]
+    try:
+        import xmltodict
+        out.append(('metadata_xmltodict', count_xmltodict))
+    except ImportError:
+        pass
+    out.extend([
+        ('json_metadata json', run_json_metadata('pg.json.gz')),
+        ('json_metadata jsonl', run_json_metadata('pg.jsonl.gz')),
+        ('json_metadata sqlite', run_json_metadata('pg.sqlite')),
+        ('popular_books tarball', run_popular()),
+        ('popular_books json', run_popular('pg.json.gz')),
+        ('popular_books jsonl', run_popular('pg.jsonl.gz')),
+        ('popular_books sqlite', run_popular('pg.sqlite')),
+        ('load json', run_load('pg.json.gz')),
+        ('load jsonl', run_load('pg.jsonl.gz')),
+        ('load sqlite', run_load('pg.sqlite')),
+        ])
+    return out
+
+def report(name, count, result):
+    elapsed, items, size, rss, err = result
+    if err:
+        print('%-24s failed: %s' % (name, err))
+        return
+    if items is None:
+        items = count
+    line = '%-24s %8.2fs %10.0f items/s' % (name, elapsed, items / max(elapsed, 1e-9))
+    if size:
+        line += ' %8.1f MB/s' % (size / 1e6 / max(elapsed, 1e-9))
+    else:
+        line += ' ' * 14
+    line += ' %8.1f MB peak' % (rss / 1024.0)
+    print(line)
+
+def main():
+    try:
+        count = int(sys.argv[1])
+        work = 'bench'
+        if len(sys.argv) > 2:
+            work = sys.argv[2]
+        seed = 0
+        if len(sys.argv) > 3:
+            seed = int(sys.argv[3])
+    except:
+        print(help_string)
+        sys.exit(1)
+    if not isdir(work):
+        os.mkdir(work)
+    rdf = join(work, 'rdf-files.tar.bz2')
+    stamp = join(work, 'corpus.txt')
+    wanted = '%i %i' % (count, seed)
+    if not (isfile(rdf) and isfile(stamp) and open(stamp).read() == wanted):
+        print('generating %i books in %s' % (count, rdf))
+        t = time.time()
+        make_corpus(rdf, count, seed)
+        open(stamp, 'w').write(wanted)
+        print('    %.1fs, %.1f MB' % (time.time() - t, os.path.getsize(rdf) / 1e6))
+    print('bz2_workers = %i' % gutenberg.bz2_workers)
+    for name, fn in stages(count):
+        report(name, count, measure(fn, work))
+
+if __name__ == '__main__':
+    main()
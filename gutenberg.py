@@ -1,8 +1,9 @@
 #! /usr/bin/env python
 
-import re, sys, gzip, json, tarfile
+import io, os, re, sys, bz2, gzip, json, mmap, hashlib, sqlite3, tarfile
+import heapq, collections, multiprocessing
 from os.path import isfile
-import xmltodict
+from xml.etree import ElementTree
 
 """
 https://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2
@@ -31,6 +32,9 @@ metadata appears to be missing the "LoC Class" field
 language field is sometimes wrong (dante's italian is all marked 'en')
 """
 
+# decompression processes for rdf-files.tar.bz2, 1 is plain tarfile
+bz2_workers = multiprocessing.cpu_count()
+
 # these have been reported upstream
 missing_titles = {
     "ebooks/997": "Divina Commedia di Dante: Inferno",
@@ -40,8 +44,125 @@ missing_titles = {
     "ebooks/49344": "The Queen's Favourite",
 }
 
-def rdf_iterator(rdf_tar):
-    "returns file object and xml text"
+BZ_BLOCK = 0x314159265359  # pi, starts every compressed block
+BZ_EOS = 0x177245385090  # sqrt(pi), ends every stream
+MASK48 = (1 << 48) - 1
+
+def bit_find(data, magic):
+    "bit offsets of a 48 bit marker anywhere in data (bzip2 is not byte aligned)"
+    found = []
+    for s in range(8):
+        # 56 bits with the marker starting s bits into the first byte
+        pattern = (magic << (8 - s)).to_bytes(7, 'big')
+        lead = 0 if s == 0 else 1
+        needle = pattern[lead:6]
+        i = data.find(needle)
+        while i != -1:
+            k = i - lead
+            if k >= 0 and k + 7 <= len(data):
+                window = int.from_bytes(data[k:k+7], 'big')
+                if (window >> (8 - s)) & MASK48 == magic:
+                    found.append(8*k + s)
+            i = data.find(needle, i + 1)
+    return sorted(found)
+
+def bz2_blocks(data):
+    "(start, end) bit ranges of the compressed blocks in a (multi-stream) bzip2 file"
+    starts = set()
+    for b in bit_find(data, BZ_BLOCK):
+        # crc(32) rand(1) origPtr(24) follow, rand is always 0 and origPtr < 900k
+        k = b // 8
+        if k + 18 > len(data):
+            continue
+        bits = int.from_bytes(data[k:k+18], 'big') >> (144 - b % 8 - 48 - 57)
+        if (bits >> 24) & 1 == 0 and bits & 0xffffff < 900000:
+            starts.add(b)
+    marks = sorted(starts | set(bit_find(data, BZ_EOS)))
+    return [(a, b) for a,b in zip(marks, marks[1:]) if a in starts]
+
+def bz2_block(chunk, skip, nbits):
+    "decompresses one block cut out of a bzip2 file, by rewrapping it as its own stream"
+    v = int.from_bytes(chunk, 'big')
+    v >>= len(chunk)*8 - skip - nbits
+    v &= (1 << nbits) - 1
+    # a one-block stream's crc is just the block's crc, which follows the marker
+    crc = (v >> (nbits - 80)) & 0xffffffff
+    v = (v << 80) | (BZ_EOS << 32) | crc
+    nbits += 80
+    pad = -nbits % 8
+    v <<= pad
+    return bz2.decompress(b'BZh9' + v.to_bytes((nbits + pad) // 8, 'big'))
+
+class ParallelBZ2(object):
+    "read-only file object, decompresses bzip2 blocks on a process pool, in order"
+    def __init__(self, path, workers):
+        self.fh = open(path, 'rb')
+        self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ranges = bz2_blocks(self.data)
+        if not self.ranges:
+            raise IOError('%s has no bzip2 blocks' % path)
+        self.pool = multiprocessing.Pool(workers)
+        self.ahead = 2 * workers
+        self.pending = collections.deque()
+        self.next = 0
+        self.buf = b''
+        self.pos = 0
+    def fill(self):
+        while len(self.pending) < self.ahead and self.next < len(self.ranges):
+            a, b = self.ranges[self.next]
+            chunk = self.data[a//8:(b+7)//8]
+            self.pending.append(self.pool.apply_async(bz2_block, (chunk, a % 8, b - a)))
+            self.next += 1
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos == len(self.buf):
+                self.fill()
+                if not self.pending:
+                    break
+                self.buf = self.pending.popleft().get()
+                self.pos = 0
+                continue
+            end = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+            parts.append(self.buf[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(parts)
+    def close(self):
+        self.pool.terminate()
+        self.data.close()
+        self.fh.close()
+
+class ParallelTar(tarfile.TarFile):
+    "stream mode tarfile over a ParallelBZ2, closing it also stops the pool"
+    source = None
+    def close(self):
+        try:
+            tarfile.TarFile.close(self)
+        finally:
+            # tarfile never closes a fileobj it was handed
+            if self.source:
+                self.source.close()
+
+def open_rdf(path="rdf-files.tar.bz2", workers=None):
+    "tarfile for the rdf feed, decompressed on all cores when there are several"
+    if workers is None:
+        workers = bz2_workers
+    if workers <= 1 or not path.endswith('.bz2'):
+        return tarfile.open(path)
+    source = ParallelBZ2(path, workers)
+    try:
+        # stream mode, the members are read front to back anyway
+        rdf = ParallelTar.open(fileobj=source, mode='r|')
+    except:
+        source.close()
+        raise
+    rdf.source = source
+    return rdf
+
+def rdf_entries(rdf_tar):
+    "returns the tar members that are ebook rdf files"
     skips = '0 999999'
     skips = set(skips.split())
     id_num = re.compile('pg([^.]*).rdf')
@@ -51,7 +172,16 @@ def rdf_iterator(rdf_tar):
         name = id_num.search(m.name).group(1)
         if name in skips:
             continue
-        xml = rdf_tar.extractfile(m).read()
+        yield m
+
+def rdf_members(rdf_tar):
+    "returns tar member and raw xml bytes"
+    for m in rdf_entries(rdf_tar):
+        yield m, rdf_tar.extractfile(m).read()
+
+def rdf_iterator(rdf_tar):
+    "returns tar member and xml text"
+    for m, xml in rdf_members(rdf_tar):
         if sys.version_info >= (3, 0):
             xml = xml.decode()
         yield m, xml
@@ -99,7 +229,377 @@ def rdf_val(rdf, recurse=False):
         error(rdf)
     return items
 
-def metadata(rdf_files):
+tag_map = {'dcterms:title': 'title',
+           'dcterms:rights': 'license',
+           'dcterms:publisher': 'publisher',
+           'dcterms:language': 'language',
+           'pgterms:downloads': 'downloads',
+           'pgterms:bookshelf': 'bookshelf',
+           'dcterms:subject': 'subjects',
+           'dcterms:type': 'media_type',
+           'dcterms:issued': 'release_date',
+          }
+quiet = 'bookshelf'.split()
+
+def clean_simple(base, data):
+    "flattens the single-valued fields, in place"
+    no_nest = 'downloads release_date media_type title license publisher'.split()
+    len_one = 'downloads media_type license publisher'.split()
+    for k in no_nest:
+        assert len(data[k]) <= 1
+        if k in len_one:
+            assert len(data[k]) == 1
+        if len(data[k]) == 0:
+            data[k] = None
+        else:
+            data[k] = data[k][0]
+
+    data['downloads'] = int(data['downloads'])
+    if data['license'] == 'None':
+        data['license'] = None
+
+    # correct missing info
+    if data['title'] is None and base in missing_titles:
+        data['title'] = missing_titles[base]
+
+namespaces = {
+    'cc': 'http://web.resource.org/cc/',
+    'dcam': 'http://purl.org/dc/dcam/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'marcrel': 'http://id.loc.gov/vocabulary/relators/',
+    'pgterms': 'http://www.gutenberg.org/2009/pgterms/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'xml': 'http://www.w3.org/XML/1998/namespace',
+}
+uri_prefix = dict(('{%s}' % v, k + ':') for k,v in namespaces.items())
+
+def clark(name):
+    "'rdf:value' -> '{http://...#}value', the way ElementTree spells it"
+    prefix, _, local = name.partition(':')
+    return '{%s}%s' % (namespaces[prefix], local)
+
+def qname(tag):
+    "inverse of clark(), for the odd bits of output that need real names"
+    if not tag.startswith('{'):
+        return tag
+    uri, _, local = tag[1:].partition('}')
+    return uri_prefix.get('{%s}' % uri, uri + ':') + local
+
+RDF_ABOUT = clark('rdf:about')
+RDF_RESOURCE = clark('rdf:resource')
+RDF_VALUE = clark('rdf:value')
+PG_EBOOK = clark('pgterms:ebook')
+PG_AGENT = clark('pgterms:agent')
+PG_FILE = clark('pgterms:file')
+PG_WEBPAGE = clark('pgterms:webpage')
+PG_NAME = clark('pgterms:name')
+PG_ALIAS = clark('pgterms:alias')
+PG_DATES = [('birth', clark('pgterms:birthdate')), ('death', clark('pgterms:deathdate'))]
+DC_CREATOR = clark('dcterms:creator')
+DC_HAS_FORMAT = clark('dcterms:hasFormat')
+DC_FORMAT = clark('dcterms:format')
+DC_MODIFIED = clark('dcterms:modified')
+DC_EXTENT = clark('dcterms:extent')
+tag_clark = [(clark(t1), t2) for t1,t2 in tag_map.items()]
+
+def xml_text(e):
+    "stripped direct text of an element, or None"
+    if len(e) == 0:
+        text = e.text
+    else:
+        text = (e.text or '') + ''.join(c.tail or '' for c in e)
+    return text and text.strip() or None
+
+def grouped(e):
+    "children bunched by tag in order of first appearance, like xmltodict"
+    if len(e) == 1:
+        return [(e[0].tag, [e[0]])]
+    tags = [c.tag for c in e]
+    if len(tags) == len(set(tags)):
+        return [(c.tag, [c]) for c in e]
+    order = []
+    groups = {}
+    for c in e:
+        if c.tag not in groups:
+            order.append(c.tag)
+            groups[c.tag] = []
+        groups[c.tag].append(c)
+    return [(t, groups[t]) for t in order]
+
+def xml_value(e):
+    "what xmltodict would have made of a single element"
+    text = xml_text(e)
+    if not e.attrib and len(e) == 0:
+        return text
+    d = {}
+    for k,v in e.attrib.items():
+        d['@' + qname(k)] = v
+    for t,cs in grouped(e):
+        d[qname(t)] = group_value(cs)
+    if text:
+        d['#text'] = text
+    return d
+
+def group_value(elems):
+    if len(elems) == 1:
+        return xml_value(elems[0])
+    return [xml_value(e) for e in elems]
+
+def rdf_values(elems):
+    "rdf_val() for a group of same-tag elements, minus the dict detour"
+    if len(elems) == 1:
+        return element_values(elems[0], False)
+    items = []
+    for e in elems:
+        items.extend(element_values(e, True))
+    return items
+
+def element_values(e, recurse):
+    "rdf_val() of whatever xmltodict would have made of the element"
+    if len(e) == 0:
+        text = e.text and e.text.strip()
+        if e.attrib:
+            # attributes are never values, text is '#text'
+            return [text] if text else []
+        if not text:
+            raise ValueError('empty %s' % qname(e.tag))
+        if recurse:
+            return []
+        return [text]
+    items = []
+    for t,cs in grouped(e):
+        if len(cs) > 1:
+            for c in cs:
+                items.extend(element_values(c, True))
+            continue
+        c = cs[0]
+        if t == RDF_VALUE and len(c) == 0 and not c.attrib and c.text and c.text.strip():
+            items.append(c.text.strip())
+            continue
+        items.extend(element_values(c, True))
+    text = xml_text(e)
+    if text:
+        items.append(text)
+    return items
+
+def xml_error(e):
+    print(ElementTree.tostring(e).decode())
+    raise
+
+def ebook_elements(xml):
+    "returns rdf:about and the ebook's children, bunched by tag"
+    # the C tree builder is far cheaper than any python-side event loop
+    ebook = ElementTree.fromstring(xml).find(PG_EBOOK)
+    return ebook.get(RDF_ABOUT), dict(grouped(ebook))
+
+def rdf_record(xml):
+    "returns (base, data) for one rdf file, data is None for de-listed items"
+    base, groups = ebook_elements(xml)
+    print(base)
+    data = {}
+    data['base_url'] = 'https://www.gutenberg.org/' + base
+    data['id'] = base
+
+    for t1,t2 in tag_clark:
+        if t1 not in groups:
+            if t2 not in quiet:
+                print('    warning: %s missing %s' % (base, t2))
+            data[t2] = []
+            continue
+        try:
+            data[t2] = rdf_values(groups[t1])
+        except:
+            xml_error(groups[t1][0])
+
+    clean_simple(base, data)
+
+    data['creators'] = []
+    creators = groups.get(DC_CREATOR, [])
+    if not creators:
+        print('    warning: %s missing %s' % (base, 'creator'))
+    for c1 in creators:
+        agents = c1.findall(PG_AGENT)
+        if not agents:
+            print('    warning: %s missing %s' % (base, 'agent'))
+            continue
+        assert len(agents) == 1
+        c1 = agents[0]
+        c2 = {}
+        c2['pg_url'] = 'http://www.gutenberg.org/ebooks/author/' + c1.get(RDF_ABOUT).split('/')[-1]
+        c2['urls'] = [u.get(RDF_RESOURCE) for u in c1.findall(PG_WEBPAGE)]
+        fields = dict(grouped(c1))
+        for k,t in PG_DATES:
+            c2[k] = None
+            if t not in fields:
+                continue
+            date = rdf_values(fields[t])
+            assert len(date) == 1
+            c2[k] = int(date[0])
+        c2['name'] = group_value(fields[PG_NAME])
+        c2['aliases'] = []
+        if PG_ALIAS in fields:
+            c2['aliases'] = [xml_value(a) for a in fields[PG_ALIAS]]
+        data['creators'].append(c2)
+
+    formats = groups.get(DC_HAS_FORMAT, [])
+    if not formats:
+        print('    error: %s missing %s' % (base, 'files'))
+        print('    error: %s will be de-listed' % base)
+        return base, None
+    if len(formats) == 1:
+        print('    warning: %s has %s' % (base, 'weird files'))
+
+    files = []
+    for f1 in formats:
+        f2 = {}
+        assert len(f1) == 1 and not f1.attrib
+        f1 = f1[0]
+        assert f1.tag == PG_FILE
+        try:
+            fields = dict(grouped(f1))
+            # usually a psuedo-url that redirects
+            f2['url'] = f1.attrib[RDF_ABOUT]
+            f2['format'] = rdf_values(fields[DC_FORMAT])
+            f2['modified'] = rdf_values(fields[DC_MODIFIED])
+            assert len(f2['modified']) == 1
+            f2['modified'] = f2['modified'][0]
+            f2['size'] = rdf_values(fields[DC_EXTENT])
+            assert len(f2['size']) == 1
+            f2['size'] = int(f2['size'][0])
+        except:
+            xml_error(f1)
+        files.append(f2)
+    data['files'] = files
+    return base, data
+
+def fingerprint(m, xml):
+    "[size, mtime, sha1] of a tar member, the ebook id gets tacked on later"
+    return [m.size, m.mtime, hashlib.sha1(xml).hexdigest()]
+
+def metadata(rdf_files, members=None):
+    "members (optional dict) collects member name -> fingerprint + id"
+    table = {}
+    for m, xml in rdf_members(rdf_files):
+        base, data = rdf_record(xml)
+        if members is not None:
+            members[m.name] = fingerprint(m, xml) + [base if data else None]
+        if data is None:
+            continue
+        yield base, share(data, table)
+
+def parse_batch(xmls):
+    "worker side, returns (base, data, printed warnings) per rdf file"
+    results = []
+    stdout = sys.stdout
+    try:
+        for xml in xmls:
+            sys.stdout = io.StringIO()
+            base, data = rdf_record(xml)
+            results.append((base, data, sys.stdout.getvalue()))
+    finally:
+        sys.stdout = stdout
+    return results
+
+def batches(rdf_files, size):
+    "lists of (name, fingerprint) and lists of xml bytes"
+    names = []
+    batch = []
+    for m, xml in rdf_members(rdf_files):
+        names.append((m.name, fingerprint(m, xml)))
+        batch.append(xml)
+        if len(batch) == size:
+            yield names, batch
+            names = []
+            batch = []
+    if batch:
+        yield names, batch
+
+def metadata_parallel(rdf_files, workers, members=None, batch_size=250):
+    "metadata() on a process pool, same tar order, warnings replayed in order"
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    table = {}
+    def drain():
+        names, result = pending.popleft()
+        for (name, fp), (base, data, log) in zip(names, result.get()):
+            sys.stdout.write(log)
+            if members is not None:
+                members[name] = fp + [base if data else None]
+            if data is not None:
+                yield base, share(data, table)
+    try:
+        # the reader stays at most a couple of batches per worker ahead
+        for names, batch in batches(rdf_files, batch_size):
+            pending.append((names, pool.apply_async(parse_batch, (batch,))))
+            if len(pending) > 2 * workers:
+                for result in drain():
+                    yield result
+        while pending:
+            for result in drain():
+                yield result
+    finally:
+        pool.terminate()
+
+def members_path(output):
+    "the fingerprint file that rides along with a catalog"
+    return output + '.members.gz'
+
+def part_path(output):
+    "where output is written before it replaces the real thing, same extension"
+    head, tail = os.path.split(output)
+    return os.path.join(head, '.part%i.%s' % (os.getpid(), tail))
+
+def load_previous(output):
+    "records by id and member fingerprints from an earlier json_metadata() run"
+    records = dict((r['id'], r) for r in load_catalog(output))
+    members = {}
+    if isfile(members_path(output)):
+        members = json.load(gzip.open(members_path(output), 'rt'))
+    return records, members
+
+def metadata_incremental(rdf_files, previous, members=None):
+    "metadata(), but reuses records of a previous run where the rdf is unchanged"
+    old_records, old_members = load_previous(previous)
+    if members is None:
+        members = {}
+    reused = 0
+    parsed = 0
+    table = {}
+    for m in rdf_entries(rdf_files):
+        old = old_members.get(m.name)
+        # de-listed items have no record to lose
+        usable = old is not None and (old[3] is None or old[3] in old_records)
+        if usable and old[:2] == [m.size, m.mtime]:
+            members[m.name] = old
+            reused += 1
+            if old[3] is not None:
+                yield old[3], old_records[old[3]]
+            continue
+        xml = rdf_files.extractfile(m).read()
+        fp = fingerprint(m, xml)
+        if usable and old[2] == fp[2]:
+            # touched but not changed
+            members[m.name] = fp + old[3:]
+            reused += 1
+            if old[3] is not None:
+                yield old[3], old_records[old[3]]
+            continue
+        base, data = rdf_record(xml)
+        members[m.name] = fp + [base if data else None]
+        parsed += 1
+        if data is not None:
+            yield base, share(data, table)
+    dropped = len(set(old_members) - set(members))
+    print('reused %i, parsed %i, dropped %i' % (reused, parsed, dropped))
+
+def ebook_number(base):
+    "'ebooks/1342' -> 1342, for sorting"
+    return int(base.split('/')[-1])
+
+def metadata_xmltodict(rdf_files):
+    "the original dict-walking parser, slow but easy to poke at"
+    import xmltodict
     for m, xml in rdf_iterator(rdf_files):
         j = xmltodict.parse(xml)
         # what about non-ebooks?  (nope, even the audio stuff is under ebook)
@@ -110,18 +610,6 @@ def metadata(rdf_files):
         data['base_url'] = 'https://www.gutenberg.org/' + base
         data['id'] = base
 
-        tag_map = {'dcterms:title': 'title',
-                   'dcterms:rights': 'license',
-                   'dcterms:publisher': 'publisher',
-                   'dcterms:language': 'language',
-                   'pgterms:downloads': 'downloads',
-                   'pgterms:bookshelf': 'bookshelf',
-                   'dcterms:subject': 'subjects',
-                   'dcterms:type': 'media_type',
-                   'dcterms:issued': 'release_date',
-                  }
-        quiet = 'bookshelf'.split()
-
         for t1,t2 in tag_map.items():
             if t1 not in j:
                 if t2 not in quiet:
@@ -133,25 +621,7 @@ def metadata(rdf_files):
             except:
                 error(j)
 
-        # clean up the simple cases
-        no_nest = 'downloads release_date media_type title license publisher'.split()
-        len_one = 'downloads media_type license publisher'.split()
-        for k in no_nest:
-            assert len(data[k]) <= 1
-            if k in len_one:
-                assert len(data[k]) == 1
-            if len(data[k]) == 0:
-                data[k] = None
-            else:
-                data[k] = data[k][0]
-
-        data['downloads'] = int(data['downloads'])
-        if data['license'] == 'None':
-            data['license'] = None
-
-        # correct missing info
-        if data['title'] is None and base in missing_titles:
-            data['title'] = missing_titles[base]
+        clean_simple(base, data)
 
         # quite possibly the worst part
         creators = []
@@ -229,62 +699,310 @@ def downloads(rdf_files):
     "takes tarfile, returns (id, downloads) tuples"
     # yes, I am killing kittens by regexing xml
     # bulk XML is hard to do fast and this is "safe" input
-    dl_num = re.compile('>([0-9]*)</pgterms:downloads>')
-    for m, xml in rdf_iterator(rdf_files):
+    dl_num = re.compile(b'>([0-9]+)</pgterms:downloads>')
+    about = re.compile(b'<pgterms:ebook rdf:about="([^"]*)"')
+    for m, xml in rdf_members(rdf_files):
         d = dl_num.search(xml)
-        if not d:
+        a = about.search(xml)
+        if not d or not a:
             print('error on', m.name)
             continue
-        yield name, int(d.group(1))
-
-def popular_books(limit=2000):
-    popular = []
+        yield a.group(1).decode(), int(d.group(1))
+
+def catalog_downloads(path):
+    "(id, downloads) tuples from an existing catalog, the tarball is not needed"
+    if is_sqlite(path):
+        catalog = Catalog(path)
+        for dl, n in catalog.ranked():
+            yield n, dl
+        catalog.close()
+        return
+    # regex again, both fields only ever appear at the top of a record
+    if is_jsonl(path):
+        dl_num = re.compile(r'"downloads":([0-9]+)')
+        id_str = re.compile(r'"id":"([^"]*)"')
+        with open_text(path, 'r') as f:
+            for line in f:
+                d = dl_num.search(line)
+                i = id_str.search(line)
+                if d and i:
+                    yield i.group(1), int(d.group(1))
+        return
+    # json_metadata's indent=2 puts record keys four spaces in
+    # and sort_keys puts downloads before id
+    dl = None
+    with open_text(path, 'r') as f:
+        for line in f:
+            if line.startswith('    "downloads": '):
+                dl = int(line[17:].rstrip().rstrip(','))
+            elif line.startswith('    "id": '):
+                yield json.loads(line[10:].rstrip().rstrip(',')), dl
+
+def popular_books(limit=2000, catalog=None):
+    "most downloaded (downloads, id), from the rdf tarball or a catalog file"
+    heap = []
     tally = 0
 
-    rdf = tarfile.open("rdf-files.tar.bz2")
-    for n,dl in downloads(rdf):
+    rdf = None
+    if catalog:
+        pairs = catalog_downloads(catalog)
+    else:
+        rdf = open_rdf()
+        pairs = downloads(rdf)
+    for n,dl in pairs:
         tally += 1
-        if len(popular) == limit and (dl, n) < popular[-1]:
-            continue
-        # no need to be clever here
-        # 90% of the runtime is iterating over the tarball
-        # (though a binary-search insert or balanced tree is fun)
-        popular.append((dl, n))
-        popular.sort(reverse=True)
-        popular = popular[:limit]
-    rdf.close()
+        # bounded min-heap, the smallest keeper sits on top
+        if len(heap) < limit:
+            heapq.heappush(heap, (dl, n))
+        elif (dl, n) > heap[0]:
+            heapq.heapreplace(heap, (dl, n))
+    if rdf:
+        rdf.close()
     print('processed %i items' % tally)
-    return popular
+    return sorted(heap, reverse=True)
+
+
+class Record(object):
+    "a catalog dict on a diet, slotted but read like a dict"
+    __slots__ = ()
+    def __init__(self, **kwargs):
+        for k,v in kwargs.items():
+            setattr(self, k, v)
+    def __getitem__(self, k):
+        try:
+            return getattr(self, k)
+        except AttributeError:
+            raise KeyError(k)
+    def __setitem__(self, k, v):
+        setattr(self, k, v)
+    def __contains__(self, k):
+        return k in self.__slots__ and hasattr(self, k)
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+    def get(self, k, default=None):
+        return getattr(self, k, default)
+    def __iter__(self):
+        return iter(self.keys())
+    def __len__(self):
+        return len(self.keys())
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other)
+        except (TypeError, ValueError):
+            return False
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class Book(Record):
+    __slots__ = ('base_url', 'bookshelf', 'creators', 'downloads', 'files', 'id',
+                 'language', 'license', 'media_type', 'publisher',
+                 'release_date', 'subjects', 'title')
+
+class Creator(Record):
+    __slots__ = ('aliases', 'birth', 'death', 'name', 'pg_url', 'urls')
+
+class BookFile(Record):
+    __slots__ = ('format', 'modified', 'size', 'url')
+
+record_shapes = dict((frozenset(c.__slots__), c) for c in (Book, Creator, BookFile))
+
+def share(v, table):
+    "swaps repeated strings and lists of strings for one shared copy, dicts in place"
+    # shared lists must not be mutated, nothing downstream does
+    if isinstance(v, str):
+        return table.setdefault(v, v)
+    if isinstance(v, list):
+        if all(isinstance(x, str) for x in v):
+            key = tuple(v)
+            if key not in table:
+                table[key] = [table.setdefault(x, x) for x in v]
+            return table[key]
+        return [share(x, table) for x in v]
+    if isinstance(v, dict):
+        for k in v:
+            v[k] = share(v[k], table)
+    return v
+
+def record_decoder(table=None):
+    "json decoder that makes slotted records with shared values"
+    if table is None:
+        table = {}
+    def hook(d):
+        # objects arrive innermost first, creators and files are already records
+        share(d, table)
+        cls = record_shapes.get(frozenset(d))
+        if cls is None:
+            return d
+        return cls(**d)
+    return json.JSONDecoder(object_hook=hook)
+
+def plain(o):
+    "json default= for records"
+    if isinstance(o, Record):
+        return dict(o.items())
+    raise TypeError('%r is not json serializable' % o)
+
+def is_sqlite(path):
+    return path.endswith('.sqlite') or path.endswith('.db')
+
+schema = """
+create table books (
+    id text primary key,
+    downloads integer not null,
+    media_type text,
+    license text,
+    title text,
+    record text not null
+);
+"""
 
+def sqlite_dump(records, output):
+    "writes records to a fresh sqlite catalog, indexed by id and downloads"
+    if isfile(output):
+        os.remove(output)
+    db = sqlite3.connect(output)
+    db.executescript(schema)
+    rows = ((v['id'], v['downloads'], v['media_type'], v['license'], v['title'],
+             json.dumps(v, sort_keys=True, separators=(',', ':'), default=plain)) for v in records)
+    db.executemany('insert into books values (?, ?, ?, ?, ?, ?)', rows)
+    # built after the bulk insert, much cheaper that way
+    db.execute('create index books_downloads on books (downloads, id)')
+    db.commit()
+    db.close()
+
+class Catalog(object):
+    "sqlite catalog, records are only decoded when asked for"
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.decode = record_decoder().decode
+    def __len__(self):
+        return self.db.execute('select count(*) from books').fetchone()[0]
+    def __contains__(self, book_id):
+        row = self.db.execute('select 1 from books where id = ?', (book_id,))
+        return row.fetchone() is not None
+    def __getitem__(self, book_id):
+        row = self.db.execute('select record from books where id = ?', (book_id,))
+        row = row.fetchone()
+        if row is None:
+            raise KeyError(book_id)
+        return self.decode(row[0])
+    def __iter__(self):
+        for row in self.db.execute('select record from books order by rowid'):
+            yield self.decode(row[0])
+    def ranked(self, limit=-1):
+        "(downloads, id) pairs, most downloaded first, no records built"
+        sql = 'select downloads, id from books order by downloads desc, id desc limit ?'
+        return self.db.execute(sql, (limit,))
+    def top(self, limit):
+        "the most downloaded records, in the same order as sorting (downloads, id)"
+        sql = 'select record from books order by downloads desc, id desc limit ?'
+        return [self.decode(r[0]) for r in self.db.execute(sql, (limit,))]
+    def close(self):
+        self.db.close()
+
+def is_jsonl(path):
+    return path.endswith('.jsonl') or path.endswith('.jsonl.gz')
+
+def open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+def jsonl_dump(records, output):
+    "one compact record per line, written as they arrive"
+    with open_text(output, 'w') as f:
+        for v in records:
+            f.write(json.dumps(v, sort_keys=True, separators=(',', ':'), default=plain))
+            f.write('\n')
+
+def read_jsonl(path):
+    "streams records back out of a json lines catalog"
+    decode = record_decoder().decode
+    with open_text(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield decode(line)
+
+def load_catalog(path):
+    "a Catalog for sqlite files, otherwise the full list of slotted records"
+    if is_sqlite(path):
+        return Catalog(path)
+    if is_jsonl(path):
+        return list(read_jsonl(path))
+    return record_decoder().decode(gzip.open(path, 'rt').read())
 
 def json_metadata():
     try:
         output = sys.argv[1]
         assert output not in  ('-h', '--help')
+        workers = 1
+        if len(sys.argv) > 2:
+            workers = int(sys.argv[2])
+        assert workers >= 1
+        previous = None
+        if len(sys.argv) > 3:
+            previous = sys.argv[3]
+            assert isfile(previous)
     except:
-        print('Use: gutenberg.py output_file.json.gz')
+        print('Use: gutenberg.py output_file.json.gz [workers] [previous.json.gz]')
         print('  Produces a lightweight summary of Project Gutenberg')
+        print('  Output names ending in .sqlite or .db make an indexed sqlite catalog')
+        print('  Names ending in .jsonl(.gz) stream one record per line (in tar order)')
+        print('  With more than one worker the RDF is parsed on a process pool')
+        print('  and the output is sorted by ebook number')
+        print('  With a previous output only new or changed RDF files are parsed')
+        print('  (fingerprints are kept next to the output as *.members.gz)')
         sys.exit(1)
-    rdf = tarfile.open("rdf-files.tar.bz2")
-    everything = []
-    for k,v in metadata(rdf):
-        everything.append(v)
-    with gzip.open(output, 'wt') as g:
-        json.dump(everything, g, indent=2, sort_keys=True)
+    rdf = open_rdf()
+    members = {}
+    if previous:
+        records = metadata_incremental(rdf, previous, members)
+    elif workers == 1:
+        records = metadata(rdf, members)
+    else:
+        records = metadata_parallel(rdf, workers, members)
+    records = (v for k,v in records)
+    if workers > 1 and not is_jsonl(output):
+        records = sorted(records, key=lambda v: ebook_number(v['id']))
+    # written aside and swapped in at the end, the output may be the previous catalog
+    part = part_path(output)
+    if is_jsonl(output):
+        jsonl_dump(records, part)
+    elif is_sqlite(output):
+        sqlite_dump(records, part)
+    else:
+        with gzip.open(part, 'wt') as g:
+            json.dump(list(records), g, indent=2, sort_keys=True, default=plain)
+    with gzip.open(members_path(part), 'wt') as g:
+        json.dump(members, g, sort_keys=True)
+    rdf.close()
+    os.replace(part, output)
+    os.replace(members_path(part), members_path(output))
 
 def list_popular():
-    # this is mostly pointless now, use something like
+    # used to lose to something like
     # zcat pg.json.gz | jshon -a -e downloads -u -p -e id -u | paste -s -d '\t\n' | sort -n | tail -n 2000 | less
-    # (it is faster too)
+    # reading the catalog directly is faster than that now
     try:
         limit = int(sys.argv[1])
         output = sys.argv[2]
+        catalog = None
+        if len(sys.argv) > 3:
+            catalog = sys.argv[3]
+            assert isfile(catalog)
     except:
-        print('Use: gutenberg.py book_count output_file')
+        print('Use: gutenberg.py book_count output_file [catalog]')
         print('  Outputs a list of the most downloaded IDs')
         print('  50000-ish total items, top 2000 seem notable')
+        print('  With a catalog (json, jsonl or sqlite) the rdf tarball is not read')
         sys.exit(1)
-    popular = popular_books(limit)
+    popular = popular_books(limit, catalog)
     with open(output, 'w') as outf:
         outf.write('\n'.join(list(zip(*popular))[1]))
 
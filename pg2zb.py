@@ -1,11 +1,14 @@
 #! /usr/bin/env python
 
-import os, re, sys, gzip, json, time, zipfile, hashlib, subprocess
-import urllib.request
+import io, os, re, sys, json, time, heapq, queue, shutil, sqlite3, zipfile, hashlib, tempfile, threading, subprocess
+import multiprocessing
+import http.client, urllib.error, urllib.parse
+import concurrent.futures
 from os.path import isfile
 from itertools import *
-from bs4 import BeautifulSoup
 import uri_converter as uri
+import gutenberg
+import text2html
 
 top_count = 1000000
 pg_size_limit = 1e6
@@ -16,8 +19,25 @@ update_conversions = False
 text_compression = 0.20  # arbitrary value for uncompressed size_limit scaling
 pg_delay = 60
 pg_skip = False
+revalidate = False  # ask servers if cached downloads changed, pair with update_conversions
+# host (or parent domain): (connections, minimum seconds between requests)
+host_limits = {'gutenberg.org': (1, pg_delay)}
+default_limit = (4, 0)
+prefetch_depth = 16  # books whose downloads are queued ahead of processing
+convert_workers = 1  # more than 1 runs the staged pipeline with a process pool
+optimize_images = False  # shrink images before inlining them, needs Pillow
+dedupe_images = None  # 'page' or 'book', see uri_converter.dedupe
+use_gutenmark = False  # for text books, text2html does them in-process otherwise
+gutenmark_workers = multiprocessing.cpu_count()  # GutenMark runs at once, split among convert_workers
+gutenmark_timeout = 600  # seconds before a hung GutenMark is killed
 mirror = 'http://www.gutenberg.lib.md.us'
+catalogs = ['pg.sqlite', 'pg.jsonl.gz', 'pg.json.gz']  # first one found is used
+cache_dir = 'cache'  # downloads, sharded by content hash, indexed by url
+journal_path = 'journal.sqlite'  # how every book went, restarts skip the settled ones
+retry_failed = False  # only rerun the books the journal has down as failed
 pg = []
+selection = None
+cache = None
 
 LOCALES = [
     'gv', 'gu', 'gd', 'ga', 'gl', 'lg', 'ln', 'lo', 'tr', 'ts', 'tn', 'to',
@@ -70,20 +90,27 @@ comment out 'broadcast' if loading directly
 """
 
 def init():
-    global pg
-    if not isfile('pg.json.gz'):
-        print('acquire pg.json.gz')
+    global pg, selection, cache
+    found = [c for c in catalogs if isfile(c)]
+    if not found:
+        print('acquire pg.json.gz (or build pg.sqlite with gutenberg.py)')
         sys.exit(1)
 
-    pg = json.load(gzip.open('pg.json.gz', 'rt'))
+    # the sqlite catalog loads instantly and is queried lazily
+    pg = gutenberg.load_catalog(found[0])
+    uri.optimize = optimize_images
+    if dedupe_images not in uri.dedupe_modes:
+        print('dedupe_images is None, page or book, not %r' % dedupe_images)
+        sys.exit(1)
+    uri.dedupe = dedupe_images
+    selection = Selection(pg)
 
-    for d in 'cache zipballs'.split():
+    for d in 'zipballs'.split():
         try:
             os.mkdir(d)
         except:
             pass
-
-pull = lambda url: urllib.request.urlopen(url).read()
+    cache = Cache(cache_dir)
 
 def call_status(cmd):
     "returns exit status"
@@ -95,32 +122,306 @@ def good_file(path):
         return False
     return os.stat(path).st_size > 0
 
-def cache_hit(url, page_cache):
-    "download logic"
-    if good_file(page_cache):
-        return
-    if not perform_downloads:
-        return
-    print('    DOWNLOADING', url)
-    if 'gutenberg.org' in url:
-        if pg_skip:
-            print('    warning: postponing for another day')
+cache_schema = """
+create table if not exists files (
+    url text primary key,
+    path text not null,  -- under cache_dir, named for the sha1
+    size integer not null,
+    sha1 text not null,
+    fetched real not null,
+    etag text,
+    modified text  -- Last-Modified, as the server sent it
+);
+"""
+
+class Cache(object):
+    "downloads filed under their content hash, with an index of url -> file"
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'partial'), exist_ok=True)
+        # lookup() adopts legacy files through store() with it held
+        self.lock = threading.RLock()
+        # the download threads share it
+        self.db = sqlite3.connect(os.path.join(root, 'index.sqlite'), check_same_thread=False)
+        self.db.executescript(cache_schema)
+        # indexes from before revalidation
+        columns = [c[1] for c in self.db.execute('pragma table_info(files)')]
+        for c in ('etag', 'modified'):
+            if c not in columns:
+                self.db.execute('alter table files add column %s text' % c)
+
+    def partial(self, url):
+        "where a download in progress goes, lookup() never sees it"
+        return os.path.join(self.root, 'partial', hashlib.sha1(url.encode('utf8')).hexdigest())
+
+    def lookup(self, url):
+        "path of a complete copy of url, or None"
+        with self.lock:
+            row = self.db.execute('select path, size from files where url = ?', (url,)).fetchone()
+            if row:
+                path = os.path.join(self.root, row[0])
+                if os.path.isfile(path) and os.path.getsize(path) == row[1]:
+                    return path
+                return None
+            # the old flat layout, adopted the first time it is asked for,
+            # under the lock so only one thread moves it
+            legacy = os.path.join(self.root, url.replace('/', '\\'))
+            if good_file(legacy):
+                return self.store(url, legacy)
+        return None
+
+    def validators(self, url):
+        "(etag, last-modified) the server sent with the cached copy, or None"
+        if not self.lookup(url):
+            return None
+        with self.lock:
+            return self.db.execute('select etag, modified from files where url = ?', (url,)).fetchone()
+
+    def touch(self, url):
+        "the server says the cached copy is current, returns its path"
+        with self.lock:
+            self.db.execute('update files set fetched = ? where url = ?', (time.time(), url))
+            self.db.commit()
+        return self.lookup(url)
+
+    def store(self, url, source, etag=None, modified=None):
+        "moves a finished file into place and indexes it, returns the new path"
+        sha1 = hashlib.sha1()
+        size = 0
+        fh = open(source, 'rb')
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(chunk)
+            size += len(chunk)
+        fh.close()
+        digest = sha1.hexdigest()
+        # keep the extension, conversions name their output after it
+        ext = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+        name = os.path.join(digest[:2], digest + ext)
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            row = self.db.execute('select path from files where url = ?', (url,)).fetchone()
+            os.replace(source, path)
+            self.db.execute('insert or replace into files values (?, ?, ?, ?, ?, ?, ?)',
+                            (url, name, size, digest, time.time(), etag, modified))
+            self.db.commit()
+            # the content changed, drop the old copy unless another url has it too
+            if row and row[0] != name and not self.db.execute(
+                    'select 1 from files where path = ?', (row[0],)).fetchone():
+                try:
+                    os.remove(os.path.join(self.root, row[0]))
+                except FileNotFoundError:
+                    pass
+        return path
+
+class HostQueue(object):
+    "downloads for one host, a few kept-alive connections and a minimum spacing"
+    def __init__(self, host, connections, delay):
+        self.host = host
+        self.delay = delay
+        self.next_start = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(connections)
+
+    def pace(self):
+        "blocks until this host may be asked for something else"
+        if not self.delay:
             return
-        print('    . . . .')
-        time.sleep(pg_delay)
-    fh = open(page_cache, 'wb')
-    fh.write(pull(url))
-    fh.close()
+        with self.lock:
+            now = time.time()
+            wait = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.delay
+        if wait > 0:
+            print('    . . . .')
+            time.sleep(wait)
+
+    def connection(self, scheme, netloc, fresh=False):
+        "one connection per thread per server, reused between requests"
+        conns = self.local.__dict__.setdefault('conns', {})
+        key = (scheme, netloc)
+        if fresh and key in conns:
+            conns.pop(key).close()
+        if key not in conns:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[key] = cls(netloc, timeout=120)
+        return conns[key]
+
+    def request(self, url, headers):
+        "sends a GET, the response is left for the caller to read"
+        parts = urllib.parse.urlsplit(url)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        for fresh in (False, True):
+            conn = self.connection(parts.scheme, parts.netloc, fresh)
+            try:
+                conn.request('GET', target, headers=headers)
+                return conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the server may have dropped an idle keep-alive connection
+                conn.close()
+                if fresh:
+                    raise
+
+    def get(self, url, headers=None, redirects=5):
+        "follows redirects, returns the unread response"
+        for _ in range(redirects + 1):
+            response = self.request(url, headers or {})
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status not in (200, 206, 304, 416):
+                response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, None)
+            return response
+        raise IOError('too many redirects for %s' % url)
+
+    def fetch(self, url):
+        "streams url into the cache, resuming or revalidating, returns the cached path"
+        self.pace()
+        part = cache.partial(url)
+        # validator of whatever the partial file holds, for If-Range
+        head = part + '.head'
+        headers = {}
+        known = cache.validators(url)
+        if known and known[0]:
+            headers['If-None-Match'] = known[0]
+        if known and known[1]:
+            headers['If-Modified-Since'] = known[1]
+        offset = 0
+        if os.path.isfile(part) and os.path.isfile(head):
+            offset = os.path.getsize(part)
+        if offset:
+            headers['Range'] = 'bytes=%i-' % offset
+            with open(head) as fh:
+                headers['If-Range'] = fh.read()
+            print('    RESUMING', url, 'at', offset)
+        elif known:
+            print('    REVALIDATING', url)
+        else:
+            print('    DOWNLOADING', url)
+        response = self.get(url, headers)
+        if response.status == 304:
+            response.read()
+            print('    unchanged', url)
+            return cache.touch(url)
+        start = 0
+        if response.status == 206:
+            # without a Content-Range there is no telling where it starts
+            match = re.match(r'bytes (\d+)-', response.getheader('Content-Range', ''))
+            start = int(match.group(1)) if match else None
+        if response.status == 416 or (response.status == 206 and start != offset):
+            # the partial file is no use, start it over
+            response.read()
+            if not offset:
+                raise IOError('%s sent a bad partial answer to a whole file request' % url)
+            for path in (part, head):
+                if os.path.isfile(path):
+                    os.remove(path)
+            return self.fetch(url)
+        if response.status == 200:
+            # weak etags are not allowed in If-Range
+            validator = response.getheader('ETag') or response.getheader('Last-Modified')
+            if validator and not validator.startswith('W/'):
+                with open(head, 'w') as fh:
+                    fh.write(validator)
+            elif os.path.isfile(head):
+                os.remove(head)
+        with open(part, 'ab' if start else 'wb') as fh:
+            while True:
+                chunk = response.read(1 << 16)
+                if not chunk:
+                    break
+                fh.write(chunk)
+        if response.length:
+            raise IOError('%s cut off at %i bytes, next try resumes' % (url, os.path.getsize(part)))
+        if os.path.isfile(head):
+            os.remove(head)
+        # only a finished file gets indexed
+        return cache.store(url, part, response.getheader('ETag'),
+                           response.getheader('Last-Modified'))
+
+class Downloader(object):
+    "per-host download queues, so one slow host never holds up the others"
+    def __init__(self, limits=None, default=None):
+        self.limits = host_limits if limits is None else limits
+        self.default = default or default_limit
+        self.hosts = {}
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def policy(self, host):
+        "(queue name, (connections, delay)), a limited domain shares one queue"
+        for name, limit in self.limits.items():
+            if host == name or host.endswith('.' + name):
+                return name, limit
+        return host, self.default
+
+    def queue(self, host):
+        "the HostQueue a host's downloads go through, call with the lock held"
+        name, limit = self.policy(host)
+        if name not in self.hosts:
+            self.hosts[name] = HostQueue(name, *limit)
+        return self.hosts[name]
+
+    def submit(self, url):
+        "returns a future for the cached path, one per url"
+        host = urllib.parse.urlsplit(url).hostname or ''
+        with self.lock:
+            if url in self.jobs:
+                return self.jobs[url]
+            q = self.queue(host)
+            job = q.pool.submit(q.fetch, url)
+            self.jobs[url] = job
+        return job
+
+    def close(self):
+        "drops whatever has not started yet"
+        for q in self.hosts.values():
+            q.pool.shutdown(wait=False, cancel_futures=True)
+
+downloader = None
+
+def schedule(url):
+    "queues a download, returns its future or None when there is nothing to do"
+    global downloader
+    if cache.lookup(url) and not revalidate:
+        return None
+    if not perform_downloads:
+        return None
+    if pg_skip and 'gutenberg.org' in url:
+        return None
+    if downloader is None:
+        downloader = Downloader()
+    return downloader.submit(url)
+
+def cache_hit(url):
+    "download logic, returns the cached path or None"
+    page_cache = cache.lookup(url)
+    job = schedule(url)
+    if job is not None:
+        try:
+            return job.result()
+        except Exception as e:
+            if not page_cache:
+                raise
+            # a failed revalidation still leaves a usable copy
+            print('    note: could not revalidate, %s' % e)
+    if page_cache:
+        return page_cache
+    if pg_skip and 'gutenberg.org' in url:
+        print('    warning: postponing for another day')
 
 def pretty(thing):
-    print(json.dumps(thing, indent=2, sort_keys=True))
+    print(json.dumps(thing, indent=2, sort_keys=True, default=gutenberg.plain))
 
 def tag_filter(nodes, tag, test_fn):
     "tag can be a single string or a list, returns items that pass test_fn"
     if type(tag) == str:
         tag = [tag]
     for n in nodes:
-        n2 = [dict(n)]
+        n2 = [n]
         for t in tag:
             if t == '*':  # for lists
                 n2 = list(chain.from_iterable(n2))
@@ -132,14 +433,49 @@ def tag_filter(nodes, tag, test_fn):
 
 preferred_types = ['application/zip', 'text/html', 'text/plain', 'charset=utf-8']
 
+class FileKind(object):
+    "a file entry's format list, parsed"
+    __slots__ = ('zip', 'types', 'content', 'charset', 'charsets')
+    def __init__(self, formats):
+        self.types = set()
+        self.charsets = []
+        for a in formats:
+            mime, _, params = a.partition(';')
+            self.types.add(mime.strip().lower())
+            for param in params.split(';'):
+                k, _, v = param.partition('=')
+                if k.strip().lower() == 'charset':
+                    self.charsets.append(v.strip().strip('"').lower())
+        # the first one named is the one to transcode from
+        self.charset = self.charsets[0] if self.charsets else None
+        self.zip = 'application/zip' in self.types
+        self.content = None
+        for t in ['text/html', 'text/plain'] + sorted(self.types - {'application/zip'}):
+            if t in self.types:
+                self.content = t
+                break
+    def matches(self, pref):
+        "pref is a mime type or charset=name, as in preferred_types"
+        if pref.startswith('charset='):
+            return pref[8:] in self.charsets
+        return pref in self.types
+
+# a few hundred distinct format lists cover the whole catalog
+file_kinds = {}
+
+def file_kind(f):
+    key = tuple(f['format'])
+    if key not in file_kinds:
+        file_kinds[key] = FileKind(key)
+    return file_kinds[key]
+
 def best_file2(node):
     "returns the biggest most html-est thing it can find"
     files = node['files']
     for pref in preferred_types:
         attempt = []
         for f in files:
-            form = f['format']
-            if any(pref in a for a in form):
+            if file_kind(f).matches(pref):
                 attempt.append(f)
         if len(attempt) == 1:
             # a winner
@@ -155,7 +491,7 @@ def best_file2(node):
     # largest file is best file
     best = list(sorted((f['size'], f['url'], f) for f in files))[-1][-1]
     # but it still needs to be something we can use
-    if not any('text/html' in a or 'text/plain' in a for a in best['format']):
+    if file_kind(best).content not in ('text/html', 'text/plain'):
         return None
     return best
 
@@ -165,11 +501,11 @@ def best_file(node):
     attempt1 = []  # zipped html (hopefully has images)
     attempt2 = []  # single html page
     for f in files:
-        form = f['format']
-        if not any('text/html' in a for a in form):
+        kind = file_kind(f)
+        if 'text/html' not in kind.types:
             continue
         attempt2.append(f)
-        if not any('application/zip' in a for a in form):
+        if not kind.zip:
             continue
         attempt1.append(f)
     if len(attempt1) == 0:
@@ -211,9 +547,6 @@ def build_info(url, **kwargs):
         info[k] = v
     return info
 
-def url_to_local(url):
-    return os.path.join('cache', url.replace('/', '\\'))
-
 def node_to_mirror(node, f):
     "provides mirror address"
     url = f['url']
@@ -224,33 +557,142 @@ def node_to_mirror(node, f):
 def node_md5(node):
     return hashlib.md5(node['base_url'].encode('utf8')).hexdigest()
 
+def zipball_path(node):
+    return os.path.join('zipballs', node_md5(node) + '.zip')
+
 def timestamp(path):
     "of the file at given path"
     mtime = time.gmtime(os.path.getmtime(path))
     return time.strftime('%Y-%m-%d %H:%M:%S UTC', mtime)
 
-def extract_text(page_cache, text_path):
+def extract_text(page_cache, out):
+    "copies the one text file in a zip into an open file, a chunk at a time"
     assert zipfile.is_zipfile(page_cache)
     z = zipfile.ZipFile(page_cache, 'r')
     text = [f for f in z.namelist() if f.lower().endswith('.txt')]
     assert len(text) == 1
-    temp = open(text_path, 'wb')
-    temp.write(z.read(text[0]))
-    temp.close()
+    src = z.open(text[0])
+    shutil.copyfileobj(src, out)
+    src.close()
+    z.close()
 
-def text_to_html(node, text_path, html_path):
-    "kind of slow, cache the html"
-    # would be nice if there was ToC support for HTML output
-    if good_file(html_path) and not update_conversions:
-        return
+class GutenMarkPool(object):
+    "a few GutenMark runs at once, each with a deadline"
+    def __init__(self, workers):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def submit(self, node, source, html_path):
+        "returns a future, one per html path"
+        with self.lock:
+            if html_path not in self.jobs:
+                self.jobs[html_path] = self.pool.submit(self.run, node, source, html_path)
+            return self.jobs[html_path]
+
+    def run(self, node, source, html_path):
+        "returns None, or what went wrong"
+        if not source.endswith('.zip'):
+            return self.convert(node, source, html_path)
+        # a private copy, conversions run side by side
+        fd, text_path = tempfile.mkstemp(suffix='.txt')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                extract_text(source, out)
+            return self.convert(node, text_path, html_path)
+        finally:
+            os.remove(text_path)
+
+    def convert(self, node, text_path, html_path):
+        authors = ' & '.join(c['name'] for c in node['creators'])
+        if not authors:
+            authors = 'unknown'
+        part = html_path + '.part'
+        cmd = ['GutenMark', '--debug', '--yes-header',
+               '--title="%s"' % node['title'], '--author="%s"' % authors,
+               text_path, part]
+        print('    running gutenmark on %s' % node['id'])
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        hung = False
+        try:
+            proc.wait(timeout=gutenmark_timeout)
+        except subprocess.TimeoutExpired:
+            hung = True
+            proc.kill()
+            proc.wait()
+        if hung:
+            problem = 'gutenmark hung'
+        elif proc.returncode < 0:
+            # killed from outside, or it fell over, worth another go
+            problem = 'gutenmark crashed'
+        elif not good_file(part):
+            problem = 'gutenmark made nothing'
+        else:
+            os.replace(part, html_path)
+            return None
+        if os.path.exists(part):
+            os.remove(part)
+        return problem
+
+    def close(self):
+        "drops whatever has not started yet"
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+gutenmark_pool = None
+
+def gutenmark(node, source, html_path):
+    "queues a conversion, returns its future"
+    global gutenmark_pool
+    if gutenmark_pool is None:
+        # each pipeline process gets its share, not the whole machine
+        processes = convert_workers if convert_workers > 1 and not debug else 1
+        gutenmark_pool = GutenMarkPool(max(1, gutenmark_workers // processes))
+    return gutenmark_pool.submit(node, source, html_path)
+
+def html_for_text(url, page_cache):
+    "where GutenMark's output for a downloaded text goes, None for odd downloads"
+    for ext in ('.txt', '.zip'):
+        if url.endswith(ext):
+            return page_cache[:-len(ext)] + '.html'
+    return None
+
+def text_opener(source):
+    "opens the book's text afresh on each call, source is the text or a zip of it"
+    if not source.endswith('.zip'):
+        return lambda: open(source, 'rb')
+    def opener():
+        z = zipfile.ZipFile(source, 'r')
+        text = [f for f in z.namelist() if f.lower().endswith('.txt')]
+        assert len(text) == 1
+        # the member stays readable after the archive is closed
+        f = z.open(text[0])
+        z.close()
+        return f
+    return opener
+
+def builtin_html(node, source, html_path, charset=None):
+    "text2html, the html only appears once it is complete, charset is the catalog's"
     authors = ' & '.join(c['name'] for c in node['creators'])
-    if not authors:
-        authors = 'unknown'
-    cmd = ['GutenMark', '--debug', '--yes-header',
-           '--title="%s"' % node['title'], '--author="%s"' % authors,
-           text_path, html_path]
-    print('    running gutenmark on %s' % node['id'])
-    call_status(cmd)
+    part = html_path + '.part'
+    out = open(part, 'w', encoding='utf-8')
+    try:
+        text2html.convert(text_opener(source), out, node['title'], authors or None, charset)
+    finally:
+        out.close()
+    os.replace(part, html_path)
+
+def text_to_html(node, source, html_path, charset=None):
+    "cache the html, source is the text or a zip of it"
+    if good_file(html_path) and not update_conversions:
+        return True
+    if not use_gutenmark:
+        builtin_html(node, source, html_path, charset)
+        return True
+    problem = gutenmark(node, source, html_path).result()
+    if problem:
+        print('    error: %s %s' % (node['id'], problem))
+        return False
+    return True
 
 def get_language(node):
     # 0.3% of books have multiple languages
@@ -272,25 +714,48 @@ def get_keywords(node):
     subjects = [re.sub(r'\s\w\s', ' ', x) for x in subjects]
     return ', '.join(subjects)
 
-def simple_zipball(node, html_path, encoding=None):
-    "single html file, no images"
+def pack_zipball(zip_path, entries):
+    "writes (name, data) entries out in order, (name, info, source zip) ones are copied raw"
+    z = zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED)
+    sources = {}
+    for entry in entries:
+        if len(entry) == 2:
+            z.writestr(*entry)
+            continue
+        name, info, source = entry
+        if source not in sources:
+            sources[source] = zipfile.ZipFile(source, 'r')
+        uri.raw_copy(sources[source], z, info, name)
+    for z1 in sources.values():
+        z1.close()
+    z.close()
+    print('    ' + os.path.basename(zip_path))
+
+def simple_entries(node, html_path, encoding=None):
+    "single html file, no images, returns (zip_path, entries) or None"
     uniq = node_md5(node)
-    zip_path = os.path.join('zipballs', uniq + '.zip')
+    zip_path = zipball_path(node)
     if good_file(zip_path) and not update_conversions:
         return
-    z = zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED)
+    entries = []
     stamp = timestamp(html_path)
     info = build_info(node['base_url'], keywords=get_keywords(node),
            language=get_language(node), title=node['title'].strip(),
            timestamp=stamp)
-    z.writestr(os.path.join(uniq, 'info.json'), json.dumps(info))
+    entries.append((os.path.join(uniq, 'info.json'), json.dumps(info)))
     if encoding:
-        utf8_html = open(html_path).decode(encoding).encode('utf8').read()
+        # writestr() stores str as utf8
+        utf8_html = open(html_path, 'rb').read().decode(encoding)
     else:
         utf8_html = open(html_path).read()
-    z.writestr(os.path.join(uniq, 'index.html'), utf8_html)
-    z.close()
-    print('    ' + uniq + '.zip')
+    entries.append((os.path.join(uniq, 'index.html'), utf8_html))
+    return zip_path, entries
+
+def simple_zipball(node, html_path, encoding=None):
+    "single html file, no images"
+    packed = simple_entries(node, html_path, encoding)
+    if packed:
+        pack_zipball(*packed)
 
 def find_htmls(z):
     return list(uri.find_html(z))
@@ -299,13 +764,16 @@ def lazy_rename(n, uniq):
     "convert old zip paths to new zip paths"
     return uniq + '/' + n.partition('/')[2]
 
-def fancy_zipball(node, pgzip_path):
+def fancy_entries(node, pgzip_path, z1=None):
     "single or multiple html page in zip file, possibly with images"
     uniq = node_md5(node)
-    zip_path = os.path.join('zipballs', uniq + '.zip')
+    zip_path = zipball_path(node)
     if good_file(zip_path) and not update_conversions:
+        if z1:
+            z1.close()
         return
-    z1 = zipfile.ZipFile(pgzip_path, 'r')
+    if z1 is None:
+        z1 = zipfile.ZipFile(pgzip_path, 'r')
     pages = list(find_htmls(z1))
     if len(pages) == 1:
         page = pages[0]
@@ -316,61 +784,75 @@ def fancy_zipball(node, pgzip_path):
         page = page[0]
     # 'page' is special and will be renamed to index.html
     old_index = os.path.basename(page.filename)
-    to_skip = uri.files_to_skip(z1)
+    images = uri.optimize_images(z1)
     replaced = set()
-    z2 = zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED)
+    entries = []
+    # the images of every page are found in one pass
+    book = uri.Pages(z1, images)
+    encoded = uri.Encoded(z1, images, book.repeated())
+    to_skip = book.files_to_skip()
+    shared = set()
+    if uri.dedupe == 'book':
+        shared = book.shared_images(to_skip)
     for i in uri.find_html(z1):
-        try:
-            # data-uri the images
-            html2, r2 = uri.process_html(z1, i, to_skip)
-        except RuntimeError:
-            # some of the html sends Soup into an infinite recursion
-            print('    error: %s broke the soup' % node['id'])
-            z2.close()
-            z1.close()
-            os.remove(zip_path)
-            return
+        # data-uri the images
+        html2, r2 = book.process(i, to_skip, encoded, shared)
         replaced |= r2
         # add all the files
         new_name = lazy_rename(i.filename, uniq)
         if i == page:
             new_name = os.path.join(uniq, 'index.html')
-        if i != page and old_index in html2:
+        if i != page and old_index.encode('utf-8') in html2:
             # never seems to happen?
             print('    error: %s has broken link to %s' % (node['id'], old_index))
-        z2.writestr(new_name, html2)
+        entries.append((new_name, html2))
         replaced.add(i.filename)
+    replaced -= book.still_used(replaced, to_skip)
+    if shared:
+        name, js = uri.shared_script(z1, shared, encoded)
+        entries.append((lazy_rename(name, uniq), js))
     img_tally = 0
     # probably should flatten directory structure
     for i in z1.infolist():
         n = i.filename
-        if n in to_skip:
-            uri.zip_rename(z1, z2, i, lazy_rename(n, uniq))
-            if uri.is_data(n):
-                img_tally += 1
-            continue
-        if n in replaced:
+        if n in replaced and n not in to_skip:
             continue
         if uri.is_data(n):
             img_tally += 1
-        uri.zip_rename(z1, z2, i, lazy_rename(n, uniq))
+        data = uri.shrunk(images, n)
+        if data is not None:
+            entries.append((lazy_rename(n, uniq), data))
+            continue
+        # untouched members are copied still compressed when packing
+        entries.append((lazy_rename(n, uniq), i, pgzip_path))
     stamp = timestamp(pgzip_path)
     info = build_info(node['base_url'], title=node['title'].strip(),
            language=get_language(node), keywords=get_keywords(node),
            timestamp=stamp)
-    z2.writestr(os.path.join(uniq, 'info.json'), json.dumps(info))
-    z2.close()
+    entries.append((os.path.join(uniq, 'info.json'), json.dumps(info)))
     z1.close()
-    print('    ' + uniq + '.zip')
+    return zip_path, entries
 
-def multipage_zipball(node, pgzip_path):
+def fancy_zipball(node, pgzip_path, z1=None):
+    "single or multiple html page in zip file, possibly with images"
+    packed = fancy_entries(node, pgzip_path, z1)
+    if packed:
+        pack_zipball(*packed)
+
+def multipage_entries(node, pgzip_path, z1=None):
     "multiple html pages in zip file, possibly with images"
     # only 6 out of the top 1000 use this
     print('    note: %s is multi-page document' % node['id'])
-    fancy_zipball(node, pgzip_path)
+    return fancy_entries(node, pgzip_path, z1)
+
+def multipage_zipball(node, pgzip_path, z1=None):
+    "multiple html pages in zip file, possibly with images"
+    packed = multipage_entries(node, pgzip_path, z1)
+    if packed:
+        pack_zipball(*packed)
 
 def get_encoding(file_node):
-    return re.search('^charset\= (*+)', file_node['format'][1])
+    return file_kind(file_node).charset
 
 """
 challenge one: figure out which file types are worth getting
@@ -412,7 +894,9 @@ these ones look promising:
 def most_popular(number):
     "top N items by download count"
     if number >= len(pg):
-        return pg
+        return list(pg)
+    if isinstance(pg, gutenberg.Catalog):
+        return pg.top(number)
     rank = list((n['downloads'], n['id'], n) for n in pg)
     rank.sort()
     rank.reverse()
@@ -438,90 +922,419 @@ def legit_filter(nodes, quiet=False):
         print('size at format:', len(nodes))
     return nodes
 
-def process_node(n):
-    print(n['id'])
+def license_class(license):
+    if not license:
+        return 'unknown'
+    if license.startswith('Public domain'):
+        return 'public domain'
+    if license.startswith('Copyrighted'):
+        return 'copyrighted'
+    return 'other'
+
+def usable_format(formats):
+    return any(f.startswith('text/html') or f.startswith('text/plain') for f in formats)
+
+# the same facts, straight out of a sqlite catalog
+selection_sql = """
+select downloads, id, media_type, license,
+    exists (select 1 from json_each(record, '$.files') f, json_each(f.value, '$.format') g
+            where substr(g.value, 1, 9) = 'text/html' or substr(g.value, 1, 10) = 'text/plain')
+from books order by rowid
+"""
+
+class Selection(object):
+    "what most_popular and legit_filter look at, worked out once per catalog load"
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.records = {}
+        if isinstance(catalog, gutenberg.Catalog):
+            rows = catalog.db.execute(selection_sql)
+        else:
+            rows = []
+            for n in catalog:
+                self.records[n['id']] = n
+                usable = any(usable_format(f['format']) for f in n['files'])
+                rows.append((n['downloads'], n['id'], n['media_type'], n['license'], usable))
+        # (downloads, id, media type, license class, has html/text)
+        self.index = [(dl, i, media, license_class(lic), bool(usable))
+                      for dl, i, media, lic, usable in rows]
+
+    def top(self, number):
+        "index entries of the most downloaded, best first"
+        if number >= len(self.index):
+            # everything, in catalog order like most_popular()
+            return list(self.index)
+        return heapq.nlargest(number, self.index)
+
+    def record(self, book_id):
+        if book_id in self.records:
+            return self.records[book_id]
+        return self.catalog[book_id]
+
+    def select(self, number, quiet=False):
+        "legit_filter(most_popular(number)), from the index"
+        rows = self.top(number)
+        counts = [('top', len(rows))]
+        rows = [r for r in rows if r[2] == 'Text']
+        counts.append(('text', len(rows)))
+        rows = [r for r in rows if r[3] == 'public domain']
+        counts.append(('public', len(rows)))
+        rows = [r for r in rows if r[4]]
+        counts.append(('format', len(rows)))
+        if not quiet:
+            for name, count in counts:
+                print('size at %s:' % name, count)
+        return [self.record(r[1]) for r in rows]
+
+def choose_download(n):
+    "returns (file entry, url), or (None, reason) for books we skip"
     promising = best_file2(n)
     if not promising:
-        print('    warning: %s has no usable text' % n['id'])
-        return
+        return None, 'has no usable text'
     scale = 1
-    if not any('application/zip' in a for a in promising['format']):
+    if not file_kind(promising).zip:
         scale = text_compression
     if (promising['size'] * scale) > pg_size_limit:
-        print('    warning: %s is too large' % n['id'])
-        return
+        return None, 'is too large'
     url = promising['url']
     if 'gutenberg.org/files/' in url:
         url = node_to_mirror(n, promising)
-    page_cache = url_to_local(url)
-    cache_hit(url, page_cache)
-    if perform_downloads and not good_file(page_cache):
+    return promising, url
+
+def prefetch(n):
+    "gets a later book's download going, quietly"
+    try:
+        promising, url = choose_download(n)
+        if not promising:
+            return
+        job = schedule(url)
+        if not use_gutenmark or not perform_conversions:
+            return
+        if 'text/plain' not in file_kind(promising).types:
+            return
+        if good_file(zipball_path(n)) and not update_conversions:
+            return
+        # GutenMark can start as soon as the text is here
+        if job is None:
+            pre_convert(n, url)
+        else:
+            job.add_done_callback(lambda j: pre_convert(n, url))
+    except Exception:
+        # process_node() will run into it again and say so
+        pass
+
+def pre_convert(n, url):
+    page_cache = cache.lookup(url)
+    html_path = page_cache and html_for_text(url, page_cache)
+    if html_path and not good_file(html_path):
+        gutenmark(n, page_cache, html_path)
+
+# http statuses that mean the file is not coming back
+gone_statuses = (404, 410)
+
+def fetch_node(n, promising, url):
+    "the download half of process_node, returns the cached path or None"
+    try:
+        page_cache = cache_hit(url)
+    except urllib.error.HTTPError as e:
+        if e.code in gone_statuses:
+            print('    error: %s is gone from the server' % n['id'])
+            return
+        # bans (403), rate limits (429) and server trouble pass, try again later
+        print('    note: HTTP %i %s' % (e.code, e.reason))
+        page_cache = None
+    except (http.client.HTTPException, OSError) as e:
+        # dropped or cut off, worth another go on a later run
+        print('    note: %s' % e)
+        page_cache = None
+    if not page_cache:
         print('    warning: %s did not download' % n['id'])
         return
     if promising['size'] != os.path.getsize(page_cache):
         print('    warning: %s is wrong size' % n['id'])
     if not perform_conversions:
         return
-    if any('text/plain' in a for a in promising['format']):
-        # simple single text file
-        if url.endswith('.txt'):
-            text_path = page_cache
-            html_path = page_cache.replace('.txt', '.html')
-        elif url.endswith('.zip'):
-            text_path = 'temp.txt'
-            extract_text(page_cache, text_path)
-            html_path = page_cache.replace('.zip', '.html')
-        else:
+    return page_cache
+
+def process_node(n):
+    print(n['id'])
+    promising, url = choose_download(n)
+    if not promising:
+        print('    warning: %s %s' % (n['id'], url))
+        return
+    page_cache = fetch_node(n, promising, url)
+    if not page_cache:
+        return
+    packed = convert_node(n, promising, url, page_cache)
+    if packed:
+        pack_zipball(*packed)
+
+def convert_node(n, promising, url, page_cache):
+    "the cpu half of process_node, returns (zip_path, entries) or None"
+    kind = file_kind(promising)
+    if 'text/plain' in kind.types:
+        # simple single text file, or a zip of one
+        html_path = html_for_text(url, page_cache)
+        if not html_path:
             print('    error: %s is a weird text file' % n['id'])
             return
         assert html_path != page_cache
-        text_to_html(n, text_path, html_path)
+        if not text_to_html(n, page_cache, html_path, kind.charset):
+            return
         try:
-            simple_zipball(n, html_path)
+            # text2html always writes utf8, GutenMark keeps the text's encoding
+            return simple_entries(n, html_path, None if use_gutenmark else 'utf-8')
         except UnicodeDecodeError:
-            simple_zipball(n, html_path, encoding=get_encoding(promising))
-        return
-    assert any('text/html' in a for a in promising['format'])
+            return simple_entries(n, html_path, encoding=get_encoding(promising))
+    assert 'text/html' in kind.types
     if not url.endswith('.zip'):
         # simple single html file
         try:
-            simple_zipball(n, page_cache)
+            return simple_entries(n, page_cache)
         except UnicodeDecodeError:
-            simple_zipball(n, page_cache, encoding=get_encoding(promising))
-        return
-    if not zipfile.is_zipfile(page_cache):
-        print('    error: %s not a zip file' % n['id'])
-        return
+            return simple_entries(n, page_cache, encoding=get_encoding(promising))
     try:
         z1 = zipfile.ZipFile(page_cache, 'r')
     except zipfile.BadZipFile:
         print('    error: %s not a zip file' % n['id'])
         return
+    # the same open zip is handed on
     page_count = len(find_htmls(z1))
-    z1.close()
     assert page_count > 0
     if page_count == 1:
-        fancy_zipball(n, page_cache)
-        return
-    multipage_zipball(n, page_cache)
+        return fancy_entries(n, page_cache, z1)
+    return multipage_entries(n, page_cache, z1)
+
+class NodeLog(object):
+    "stdout stand-in, threads that ask for it get their prints held back"
+    def __init__(self, real):
+        self.real = real
+        self.local = threading.local()
+    def write(self, s):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            return self.real.write(s)
+        if self.local.tee:
+            self.real.write(s)
+        return buf.write(s)
+    def flush(self):
+        self.real.flush()
+    def capture(self, tee=False):
+        "tee still prints as it goes, but keeps a copy"
+        self.local.buf = io.StringIO()
+        self.local.tee = tee
+    def release(self):
+        text = self.local.buf.getvalue()
+        self.local.buf = None
+        return text
+
+# the last complaint about a book names what went wrong with it
+postponed = ['postponing for another day', 'did not download']
+# known reasons a book will never convert, anything unexpected gets another go
+failures = ['has no usable text', 'is too large', 'is a weird text file', 'not a zip file',
+            'is gone from the server', 'gutenmark hung', 'gutenmark made nothing']
+
+def unknown_error(n, kind):
+    "the complaint for an exception nobody saw coming, kind is its type name"
+    print('    ERROR: %s unknown error, %s' % (n['id'], kind))
+
+def outcome(n, text):
+    "(state, error class) of a book, from its zipball and whatever it printed"
+    if good_file(zipball_path(n)):
+        return 'done', None
+    complaints = []
+    for line in text.splitlines():
+        kind, _, what = line.strip().partition(': ')
+        if kind.lower() in ('warning', 'error'):
+            complaints.append(what.replace(n['id'], '').strip())
+    if not complaints:
+        return 'postponed', 'no zipball'
+    if complaints[-1] in postponed:
+        return 'postponed', complaints[-1]
+    if complaints[-1] in failures:
+        return 'failed', complaints[-1]
+    return 'crashed', complaints[-1]
+
+journal_schema = """
+create table if not exists jobs (
+    id text primary key,
+    state text not null,  -- done, failed, postponed or crashed
+    error text,           -- last complaint, for anything not done
+    started real,
+    seconds real,
+    size integer          -- of the zipball
+);
+"""
+
+class Journal(object):
+    "sqlite record of how each book went, so a restart can skip ahead"
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(journal_schema)
+    def pending(self, nodes):
+        "drops settled books, or keeps only the failed ones when retrying"
+        states = dict(self.db.execute('select id, state from jobs'))
+        if retry_failed:
+            nodes = [n for n in nodes if states.get(n['id']) == 'failed']
+        elif not update_conversions:
+            nodes = [n for n in nodes if states.get(n['id']) not in ('done', 'failed')]
+        print('size at journal:', len(nodes))
+        return nodes
+    def record(self, n, text, started):
+        state, error = outcome(n, text)
+        size = None
+        if state == 'done':
+            size = os.path.getsize(zipball_path(n))
+        self.db.execute('insert or replace into jobs values (?, ?, ?, ?, ?, ?)',
+                        (n['id'], state, error, started, time.time() - started, size))
+        self.db.commit()
+    def report(self):
+        rows = self.db.execute('select state, error, count(*) from jobs '
+                               'group by state, error order by count(*) desc')
+        for state, error, count in rows:
+            print('%i %s%s' % (count, state, ', ' + error if error else ''))
+    def close(self):
+        self.db.close()
+
+def convert_job(n, promising, url, page_cache):
+    "runs in a worker process, returns (printed text, packed, exception type or None)"
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        packed = convert_node(n, promising, url, page_cache)
+        failed = None
+    except Exception as e:
+        packed = None
+        failed = type(e).__name__
+    text = sys.stdout.getvalue()
+    sys.stdout = stdout
+    return text, packed, failed
+
+def pipeline(nodes, workers, journal=None):
+    "select -> fetch -> convert (process pool) -> pack, bounded queues in between"
+    log = NodeLog(sys.stdout)
+    sys.stdout = log
+    fetch_q = queue.Queue(prefetch_depth)
+    convert_q = queue.Queue(2 * workers)
+    pool = multiprocessing.Pool(workers)
+
+    def select():
+        for n in nodes:
+            log.capture()
+            started = time.time()
+            plan = None
+            try:
+                print(n['id'])
+                promising, url = choose_download(n)
+                if promising:
+                    # downloads start here, fetch just waits on them
+                    schedule(url)
+                    plan = (promising, url)
+                else:
+                    print('    warning: %s %s' % (n['id'], url))
+            except Exception as e:
+                unknown_error(n, type(e).__name__)
+            fetch_q.put((n, log.release(), plan, started))
+        fetch_q.put(None)
+
+    def fetch():
+        while True:
+            item = fetch_q.get()
+            if item is None:
+                break
+            n, text, plan, started = item
+            job = None
+            log.capture()
+            try:
+                if plan:
+                    page_cache = fetch_node(n, *plan)
+                    if page_cache:
+                        job = pool.apply_async(convert_job, (n,) + plan + (page_cache,))
+            except Exception as e:
+                unknown_error(n, type(e).__name__)
+            convert_q.put((n, text + log.release(), job, started))
+        convert_q.put(None)
+
+    stages = [threading.Thread(target=select), threading.Thread(target=fetch)]
+    for t in stages:
+        t.daemon = True
+        t.start()
+    # pack, in order, on this thread
+    try:
+        while True:
+            item = convert_q.get()
+            if item is None:
+                break
+            n, text, job, started = item
+            log.real.write(text)
+            log.capture(tee=True)
+            try:
+                if job is not None:
+                    worker_text, packed, failed = job.get()
+                    sys.stdout.write(worker_text)
+                    if failed:
+                        unknown_error(n, failed)
+                    elif packed:
+                        pack_zipball(*packed)
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                unknown_error(n, type(e).__name__)
+            text += log.release()
+            if journal:
+                journal.record(n, text, started)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        sys.stdout = log.real
+
+def serial(nodes, journal=None):
+    "one book at a time, with downloads queued a few books ahead"
+    log = NodeLog(sys.stdout)
+    sys.stdout = log
+    for n in nodes[:prefetch_depth]:
+        prefetch(n)
+    try:
+        for i,n in enumerate(nodes):
+            # keep the download queues busy while this book is converted
+            if i + prefetch_depth < len(nodes):
+                prefetch(nodes[i + prefetch_depth])
+            started = time.time()
+            log.capture(tee=True)
+            try:
+                process_node(n)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                if debug:
+                    raise
+                unknown_error(n, type(e).__name__)
+            text = log.release()
+            if journal:
+                journal.record(n, text, started)
+    finally:
+        sys.stdout = log.real
 
 def main():
     init()
-    nodes = most_popular(top_count)
-    #nodes = pg
-    nodes = legit_filter(nodes)
+    nodes = selection.select(top_count)
+    journal = None
+    if journal_path and perform_conversions:
+        journal = Journal(journal_path)
+        nodes = journal.pending(nodes)
 
-    for n in nodes:
-        if debug:
-            process_node(n)
-            continue
-        try:
-            process_node(n)
-        except KeyboardInterrupt:
-            break
-        except:
-            print('    ERROR: %s unknown error' % n['id'])
-            continue
+    if convert_workers > 1 and not debug:
+        pipeline(nodes, convert_workers, journal)
+    else:
+        serial(nodes, journal)
+    if downloader:
+        downloader.close()
+    if gutenmark_pool:
+        gutenmark_pool.close()
+    if journal:
+        journal.report()
+        journal.close()
 
 if __name__ == '__main__':
     main()
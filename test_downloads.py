@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+"""
+Checks the pg2zb download queues against a local stand-in server.
+python test_downloads.py
+"""
+
+import os, time, random, shutil, tempfile, threading, unittest
+import http.server, socketserver
+
+import pg2zb
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    "serves files from memory, honours Range/If-Range and can hang up halfway"
+    files = {}
+    etag = '"v1"'
+    cut = set()  # paths whose next response stops halfway through
+    bare = set()  # paths whose 206 leaves out the Content-Range
+    log = []  # (time, path, range header) of every request
+
+    def do_GET(self):
+        self.log.append((time.time(), self.path, self.headers.get('Range')))
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+        data = self.files[self.path]
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == self.etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            if self.path not in self.bare:
+                self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.path in self.cut:
+            self.cut.discard(self.path)
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        pg2zb.cache = pg2zb.Cache(os.path.join(self.tmp, 'cache'))
+        self.server = Server(('127.0.0.1', 0), StandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = 'http://127.0.0.1:%i' % self.server.server_port
+        r = random.Random(1)
+        StandIn.files = dict(('/%i.zip' % i, bytes(r.getrandbits(8) for _ in range(100000)))
+                             for i in range(3))
+        StandIn.cut = set()
+        StandIn.bare = set()
+        StandIn.log = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        pg2zb.cache.db.close()
+        shutil.rmtree(self.tmp)
+
+    def test_resume(self):
+        q = pg2zb.HostQueue('127.0.0.1', 1, 0)
+        url = self.base + '/0.zip'
+        StandIn.cut.add('/0.zip')
+        with self.assertRaises(Exception):
+            q.fetch(url)
+        partial = pg2zb.cache.partial(url)
+        have = os.path.getsize(partial)
+        self.assertTrue(0 < have < 100000)
+        path = q.fetch(url)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), StandIn.files['/0.zip'])
+        self.assertEqual(StandIn.log[-1][2], 'bytes=%i-' % have)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_resume_without_content_range(self):
+        q = pg2zb.HostQueue('127.0.0.1', 1, 0)
+        url = self.base + '/1.zip'
+        StandIn.cut.add('/1.zip')
+        with self.assertRaises(Exception):
+            q.fetch(url)
+        StandIn.bare.add('/1.zip')
+        path = q.fetch(url)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), StandIn.files['/1.zip'])
+        # the resume was refused and the file fetched over from the start
+        self.assertEqual([r is None for t, p, r in StandIn.log], [True, False, True])
+
+    def test_pacing(self):
+        delay = 0.3
+        d = pg2zb.Downloader({'127.0.0.1': (2, delay)})
+        jobs = [d.submit(self.base + '/%i.zip' % i) for i in range(3)]
+        for job in jobs:
+            job.result()
+        d.close()
+        starts = sorted(t for t, path, r in StandIn.log)
+        self.assertEqual(len(starts), 3)
+        for a, b in zip(starts, starts[1:]):
+            self.assertGreaterEqual(b - a, delay * 0.9)
+
+    def test_domain_shares_queue(self):
+        d = pg2zb.Downloader({'gutenberg.org': (1, 60)})
+        q = d.queue('www.gutenberg.org')
+        self.assertIs(q, d.queue('gutenberg.org'))
+        self.assertIs(q, d.queue('aleph.gutenberg.org'))
+        self.assertIsNot(q, d.queue('example.com'))
+        self.assertEqual(len(d.hosts), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+
+import io, re, sys, html, codecs, collections
+
+help_string = """\
+Use:
+python text2html.py book.txt book.html [title] [author]
+
+Turns a Project Gutenberg plain text book into a single html page.
+The PG header and footer are set apart, blank-line separated blocks
+become paragraphs (indented lines, or lines well short of the book's
+usual width, keep their breaks, for verse and lists), chapter-ish
+headings get anchors and a table of contents, and _underscores_ /
+*asterisks* become italic / bold.
+
+Reads the text twice (once for the contents and the line width) and
+never holds more than a paragraph of it, so large books convert in
+bounded memory.
+"""
+
+start_re = re.compile(r'^\s*\*+\s*start of (the|this) project gutenberg|^\*end\*the small print', re.I)
+end_re = re.compile(r'^\s*\*+\s*end of (the|this) project gutenberg|^\s*end of (the )?project gutenberg', re.I)
+heading_re = re.compile(r'^(chapter|book|part|volume|stave|act|scene|section|canto|letter|'
+                        r'prologue|epilogue|preface|introduction|contents|appendix)\b'
+                        r'|^[IVXLCDM]+\.?$|^\d+\.?$', re.I)
+charset_re = re.compile(br'character set encoding:\s*([\w-]+)', re.I)
+# only markers with no word character on their outer side, snake_case_name and 5*3*2 stay
+italic_re = re.compile(r'(?<!\w)_([^_\s](?:[^_]*[^_\s])?)_(?!\w)')
+bold_re = re.compile(r'(?<!\w)\*([^*\s](?:[^*]*[^*\s])?)\*(?!\w)')
+
+header_lines = 400  # the START marker is expected within this many lines
+max_block = 500  # lines, longer paragraphs are split so memory stays bounded
+verse_width = 0.75  # of the usual line width, paragraphs with no line this long keep their breaks
+
+def sniff_encoding(f, default=None):
+    "what the PG header says the text is in, else default (the catalog's charset), else utf-8"
+    found = charset_re.search(f.read(16384))
+    names = [found.group(1).decode('ascii')] if found else []
+    for name in names + [default]:
+        if not name:
+            continue
+        name = name.lower()
+        if name in ('ascii', 'us-ascii'):
+            # plenty of 'ascii' books have the odd latin-1 byte
+            return 'latin-1'
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def sections(lines):
+    "('header'|'body'|'footer', line), the markers themselves go with header/footer"
+    lines = iter(lines)
+    ahead = []
+    started = False
+    for line in lines:
+        ahead.append(line)
+        if start_re.match(line):
+            started = True
+            break
+        if len(ahead) >= header_lines:
+            break
+    section = 'body'
+    if started:
+        for line in ahead:
+            yield 'header', line
+        ahead = []
+    for line in ahead:
+        yield section, line
+    for line in lines:
+        if section == 'body' and end_re.match(line):
+            section = 'footer'
+        yield section, line
+
+def events(lines):
+    "('header'|'footer', line), ('heading', text) and ('para', lines)"
+    gap = 0
+    block = []
+    def flush():
+        if not block:
+            return None
+        first = block[0].strip()
+        if gap >= 2 and len(block) <= 3 and all(len(l) <= 70 for l in block) \
+                and heading_re.match(first):
+            return 'heading', ' '.join(l.strip() for l in block)
+        return 'para', list(block)
+    for section, line in sections(lines):
+        line = line.rstrip('\r\n').expandtabs().rstrip()
+        if section != 'body':
+            e = flush()
+            if e:
+                yield e
+            block = []
+            gap = 0
+            yield section, line
+            continue
+        if not line:
+            e = flush()
+            if e:
+                yield e
+                block = []
+                gap = 0
+            gap += 1
+            continue
+        block.append(line)
+        if len(block) >= max_block:
+            yield flush()
+            block = []
+            gap = 0
+    e = flush()
+    if e:
+        yield e
+
+def emphasis(text):
+    text = html.escape(text, quote=False)
+    text = italic_re.sub(r'<i>\1</i>', text)
+    return bold_re.sub(r'<b>\1</b>', text)
+
+def line_width(lengths):
+    "the width the text was wrapped at, from a Counter of line lengths"
+    total = sum(lengths.values())
+    if not total:
+        return 72
+    # most lines of a paragraph run to the wrap, only the last falls short
+    seen = 0
+    for length in sorted(lengths, reverse=True):
+        seen += lengths[length]
+        if seen >= total * 0.1:
+            return length
+
+def paragraph(lines, width=72):
+    # verse, lists and tables keep their line breaks
+    short = max(len(l) for l in lines) < verse_width * width
+    if len(lines) > 1 and (short or any(l.startswith('  ') for l in lines)):
+        return '<p class="lines">%s</p>\n' % '<br>\n'.join(emphasis(l.strip()) for l in lines)
+    return '<p>%s</p>\n' % emphasis(' '.join(l.strip() for l in lines))
+
+page_head = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%s</title>
+<style>
+body { max-width: 40em; margin: auto; padding: 0 1em; line-height: 1.4; }
+.pg { font-size: 0.8em; white-space: pre-wrap; color: #555; }
+.lines { margin-left: 2em; }
+</style>
+</head>
+<body>
+"""
+
+def convert(opener, out, title=None, author=None, charset=None):
+    """opener() returns the text as a fresh binary file each time,
+    out is a text file the html is written to,
+    charset is used when the PG header does not name one"""
+    f = opener()
+    encoding = sniff_encoding(f, charset)
+    f.close()
+    def lines():
+        return io.TextIOWrapper(opener(), encoding=encoding, errors='replace', newline='')
+    # first pass, only the headings and how wide the lines run
+    f = lines()
+    headings = []
+    lengths = collections.Counter()
+    for kind, value in events(f):
+        if kind == 'heading':
+            headings.append(value)
+        elif kind == 'para':
+            lengths.update(len(l) for l in value)
+    f.close()
+    width = line_width(lengths)
+    out.write(page_head % html.escape(title or 'untitled'))
+    if title:
+        out.write('<h1>%s</h1>\n' % html.escape(title))
+    if author:
+        out.write('<h2>%s</h2>\n' % html.escape(author))
+    if headings:
+        out.write('<ul class="toc">\n')
+        for i,text in enumerate(headings):
+            out.write('<li><a href="#ch%i">%s</a></li>\n' % (i, html.escape(text)))
+        out.write('</ul>\n')
+    f = lines()
+    pre = None  # the header or footer being written
+    chapter = 0
+    for kind, value in events(f):
+        if kind in ('header', 'footer'):
+            if pre != kind:
+                if pre:
+                    out.write('</div>\n')
+                out.write('<div class="pg %s">' % kind)
+                pre = kind
+            out.write(html.escape(value, quote=False) + '\n')
+            continue
+        if pre:
+            out.write('</div>\n')
+            pre = None
+        if kind == 'heading':
+            out.write('<h3 id="ch%i">%s</h3>\n' % (chapter, html.escape(value)))
+            chapter += 1
+        else:
+            out.write(paragraph(value, width))
+    if pre:
+        out.write('</div>\n')
+    f.close()
+    out.write('</body>\n</html>\n')
+
+def main():
+    try:
+        text_path, html_path = sys.argv[1:3]
+        assert text_path not in ('-h', '--help')
+    except:
+        print(help_string)
+        sys.exit(1)
+    title = None
+    author = None
+    if len(sys.argv) > 3:
+        title = sys.argv[3]
+    if len(sys.argv) > 4:
+        author = sys.argv[4]
+    out = open(html_path, 'w', encoding='utf-8')
+    convert(lambda: open(text_path, 'rb'), out, title, author)
+    out.close()
+
+if __name__ == '__main__':
+    main()
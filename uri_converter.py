@@ -1,19 +1,45 @@
 #! /usr/bin/env python
 
-import os, re, sys, base64, zipfile
+import io, os, re, sys, html, json, time, base64, shutil, struct, zipfile, tempfile
+import urllib.parse
+import concurrent.futures.process
 from os.path import isdir, isfile, dirname, basename, splitext
 
-from bs4 import BeautifulSoup
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 help_string = """\
 Use:
 python converter.py path/to/a/page.zip
 python converter.py path/to/many/zips/
+python converter.py --optimize path/to/a/page.zip
+python converter.py --dedupe=page path/to/a/page.zip
+python converter.py --workers=4 path/to/many/zips/
 
-Embeds page content inline as data URIs.
+Embeds page content inline as data URIs: img tags and their srcset,
+<input type=image>, SVGs in <object> and <embed>, linked stylesheets
+(which become style elements) and the images in CSS url()s.  All of
+it counts against the same 1MB limit.
+With --optimize (needs Pillow) images are first shrunk to fit
+max_image_size and recompressed, so more of them fit under the
+inlining limit.
+With --dedupe=page an image repeated on a page is inlined once and the
+repeats copy it by script.  --dedupe=book also moves images used by
+several pages into one shared _inlined.js that every page loads.  That
+is one more request per page, but it is the same file every time and
+the browser caches it, so it only pays off for books whose pages share
+a lot of images.
+Pages are streamed through a small tokenizer instead of being parsed,
+only inlined references change and every other byte is left as it was.
 Can take any number and combination of files and directories.
+With --workers=N that many zips are converted at once, each in its own
+process, and a zip that fails does not stop the others.  A zip whose
+worker process dies is tried once more on its own before it is failed.
 Revised versions of the pages will be saved to the current directory.
-The utility will never overwrite an existing zipball.
+The utility will never overwrite an existing zipball, each one is
+written to a temporary file and only linked into place once complete.
 
 Tested against everything at archive.outernet.is
 Processes 37.2 MB/minute of content on a wimpy laptop.
@@ -24,16 +50,24 @@ Average page has 10 images, in theory will boost performance 10x.
 BUGS:
 The info.json file will have an incorrect image field.
 Probably misses some edge cases.
-Could be 40% faster, soups every page twice.
-Only supports images in <img> tags.
+Stylesheets pulled in by @import stay links.
 """
 
-data_extensions = 'jpg png gif'
+data_extensions = 'jpg jpeg png gif svg'
 data_extensions = set('.'+e for e in data_extensions.split())
 
 html_extensions = 'html htm'
 html_extensions = set('.'+e for e in html_extensions.split())
 
+optimize = False  # shrink images before inlining, needs Pillow
+max_image_size = (1200, 1200)  # bigger images are scaled down to fit
+jpeg_quality = 85
+convert_to = None  # e.g. 'WEBP', opaque images are re-encoded to it
+dedupe = None  # 'page' inlines repeats once per page, 'book' shares images across pages
+dedupe_modes = (None, 'page', 'book')
+workers = 1  # zips converted at once, each in its own process
+part_dir = '.'  # where zipballs are written before they are published, main() makes one per run
+
 zf = zipfile.ZipFile
 
 def iszip(path):
@@ -91,32 +125,58 @@ def smart_join(path1, path2):
         p3 = re.sub('/[^/]*/\.\./', '/', p3, count=1)
     return p3
 
-def files_to_skip(z, limit=1e6):
+def files_to_skip(z, limit=1e6, images=None):
     "set of absolute zip names that exceed the limit size"
-    size = dict((i.filename, i.file_size) for i in z.infolist())
-    total = dict((i.filename, 0) for i in z.infolist())
-    skip = set()
-    for i in find_html(z):
-        name = i.filename
-        html = z.open(i).read()
-        soup = BeautifulSoup(html)
-        base_path = dirname(name)
-        # ignore html files
-        size.pop(name)
-        total.pop(name)
-        for img in soup.find_all('img'):
-            if img['src'].startswith('data:'):
-                continue
-            # figure out the absolute path
-            img_path = smart_join(base_path, img['src'])
-            if img_path not in size:
-                print("    warning: missing %s" % img_path)
-                #skip.add(img_path)
-                continue
-            total[img_path] += size[img_path]
-    skip.update(n for n,s in size.items() if s > limit)
-    skip.update(n for n,s in total.items() if s > limit)
-    return skip
+    return Pages(z, images).files_to_skip(limit)
+
+def optimize_image(data):
+    "(smaller data, extension) or None when it would not help"
+    img = Image.open(io.BytesIO(data))
+    if getattr(img, 'is_animated', False):
+        return None
+    img.load()
+    fmt = img.format
+    alpha = 'A' in img.getbands() or 'transparency' in img.info
+    if convert_to and not (alpha and convert_to == 'JPEG'):
+        fmt = convert_to
+    resized = img.width > max_image_size[0] or img.height > max_image_size[1]
+    if resized:
+        img.thumbnail(max_image_size, Image.LANCZOS)
+    out = io.BytesIO()
+    if fmt == 'JPEG':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(out, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        img.save(out, 'PNG', optimize=True)
+    elif fmt == 'GIF':
+        img.save(out, 'GIF', optimize=True)
+    elif fmt == 'WEBP':
+        img.save(out, 'WEBP', quality=jpeg_quality, method=6)
+    else:
+        return None
+    new = out.getvalue()
+    if len(new) >= len(data) and not resized:
+        return None
+    return new, '.' + fmt.lower().replace('jpeg', 'jpg')
+
+def optimize_images(z):
+    "{name: (data, extension)} for the images in z that came out smaller"
+    images = {}
+    if not optimize:
+        return images
+    if Image is None:
+        print('    warning: image optimization needs Pillow')
+        return images
+    for i in find_data(z):
+        try:
+            better = optimize_image(z.read(i))
+        except Exception:
+            # Pillow could not make sense of it, leave it be
+            continue
+        if better:
+            images[i.filename] = better
+    return images
 
 def encode_file(z, abs_name):
     try:
@@ -132,72 +192,841 @@ def mime_table(tag, ext):
     "very incomplete"
     table = {('img', 'png'): 'image/png',
              ('img', 'jpg'): 'image/jpg',
-             ('img', 'gif'): 'image/gif',}
+             ('img', 'jpeg'): 'image/jpeg',
+             ('img', 'svg'): 'image/svg+xml',
+             ('img', 'gif'): 'image/gif',
+             ('img', 'webp'): 'image/webp',}
     if (tag, ext) not in table:
         return 'application/octet-stream'
     return table[(tag, ext)]
 
-def image_data_uri(img_soup, b64):
-    "modifies the soup in place"
-    ext = splitext(img_soup['src'])[1].strip('.')
-    mime = mime_table('img', ext)
-    img_soup['src'] = data_url(mime, b64)
+class Encoded(object):
+    "data uris for one zip, the repeated names are only encoded once"
+    def __init__(self, z, images=None, repeated=()):
+        self.z = z
+        self.images = images or {}
+        # only these are kept, the rest are encoded and dropped
+        self.repeated = repeated
+        self.uris = {}
+    def uri(self, name, ext):
+        if name in self.uris:
+            return self.uris[name]
+        if name in self.images:
+            data, ext = self.images[name]
+            b64 = base64.b64encode(data).decode()
+        else:
+            b64 = encode_file(self.z, name)
+        uri = data_url(mime_table('img', ext.strip('.')), b64)
+        if name in self.repeated:
+            self.uris[name] = uri
+        return uri
 
-def process_html(z, i, to_skip):
-    "returns (new_html, replaced_files)"
-    replaced = set()
-    root_path = dirname(i.filename)
-    html = z.open(i).read()
-    soup = BeautifulSoup(html)
-    for img in soup.find_all('img'):
-        if img['src'].startswith('data:'):
-            continue
-        n = smart_join(root_path, img['src'])
-        if n in to_skip:
+# stands in for a repeated image until the script below copies it over
+blank_gif = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+
+copy_script = """
+(function () {
+  var imgs = document.getElementsByTagName('img');
+  for (var i = 0; i < imgs.length; i++) {
+    var key = imgs[i].getAttribute('data-inline');
+    if (!key) continue;
+    if (window.inlined && window.inlined[key]) {
+      imgs[i].src = window.inlined[key];
+    } else {
+      imgs[i].src = document.getElementById(key).src;
+    }
+  }
+})();
+"""
+
+def html_root(z):
+    "deepest directory holding every html page"
+    dirs = [dirname(i.filename) for i in find_html(z)]
+    if not dirs:
+        return ''
+    return os.path.commonpath(dirs)
+
+def shared_images(z, to_skip):
+    "inlined images used by more than one page, for dedupe = 'book'"
+    return Pages(z).shared_images(to_skip)
+
+def shared_script(z, shared, encoded):
+    """(zip name, javascript) holding the shared images,
+    pages load it with a request of their own"""
+    uris = dict((n, encoded.uri(n, splitext(n)[1])) for n in sorted(shared))
+    return os.path.join(html_root(z), '_inlined.js'), 'var inlined = %s;\n' % json.dumps(uris)
+
+chunk_size = 1 << 16  # pages are read this much at a time
+max_tag = 1 << 16  # a tag with an unclosed quote ends at its first '>' past this
+
+# the only markup the rewriter has to understand, every other byte passes through
+opener_re = re.compile(br'<(?:!--|script\b|style\b|/body\b|[a-zA-Z])', re.I)
+tag_re = re.compile(br'''<[a-zA-Z](?:[^>"']|"[^"]*"|'[^']*')*>''')
+tag_name_re = re.compile(br'<([^\s/>]+)')
+attr_re = re.compile(br'''([^\s"'<>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?''')
+close_re = {b'<script': re.compile(br'</script\s*>', re.I),
+            b'<style': re.compile(br'</style\s*>', re.I)}
+# and in css
+url_re = re.compile(br'''url\(\s*("[^"]*"|'[^']*'|[^)"'\s]*)\s*\)''', re.I)
+import_re = re.compile(br'''@import\s+("[^"]*"|'[^']*')''', re.I)
+scheme_re = re.compile(r'[a-zA-Z][\w+.-]*:')
+
+# tags that can point at something worth inlining
+resource_tags = set('img source input object embed link'.split())
+
+def token_end(buf, m, eof):
+    "where the token m opens ends in buf, None if it needs more of the page"
+    opener = m.group().lower()
+    if opener == b'<!--':
+        i = buf.find(b'-->', m.end())
+        return None if i < 0 else i + 3
+    if opener in close_re:
+        c = close_re[opener].search(buf, m.end())
+        return c and c.end()
+    if opener != b'</body':
+        t = tag_re.match(buf, m.start())
+        if t:
+            return t.end()
+        # a stray quote, end the tag where a browser would instead of reading on
+        if not eof and len(buf) - m.start() < max_tag:
+            return None
+    i = buf.find(b'>', m.end())
+    return None if i < 0 else i + 1
+
+def tokens(f):
+    """(kind, bytes) of a page read from f, kind is the name of a start tag,
+    'style' for a whole style element, 'body end' or None for the rest"""
+    buf = b''
+    eof = False
+    while not eof:
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+        pos = 0
+        while True:
+            m = opener_re.search(buf, pos)
+            end = m and token_end(buf, m, eof)
+            if end is None:
+                # hold back an unfinished token, or what could be half an opener
+                stop = m.start() if m else max(pos, len(buf) - 7)
+                if eof:
+                    stop = len(buf)
+                if stop > pos:
+                    yield None, buf[pos:stop]
+                pos = stop
+                break
+            if m.start() > pos:
+                yield None, buf[pos:m.start()]
+            opener = m.group().lower()
+            if opener == b'<style':
+                kind = 'style'
+            elif opener == b'</body':
+                kind = 'body end'
+            elif opener in (b'<!--', b'<script'):
+                kind = None
+            else:
+                kind = tag_name_re.match(buf, m.start()).group(1).decode('latin-1').lower()
+            yield kind, buf[m.start():end]
+            pos = end
+        buf = buf[pos:]
+
+def text(raw):
+    "an attribute's bytes as text"
+    return html.unescape(raw.decode('utf-8', 'replace')).strip()
+
+def attributes(tag):
+    "{name: ((start, end), raw bytes, text)} of a start tag, the values are None when it has none"
+    found = {}
+    for a in attr_re.finditer(tag, tag_name_re.match(tag).end(), len(tag) - 1):
+        name = a.group(1).decode('latin-1').lower()
+        raw = a.group(2)
+        value = None
+        if raw is not None:
+            if raw[:1] in (b'"', b"'"):
+                raw = raw[1:-1]
+            value = text(raw)
+        # browsers keep the first of a repeated attribute
+        found.setdefault(name, (a.span(), raw, value))
+    return found
+
+def escaped(value):
+    return html.escape(value).encode('ascii', 'xmlcharrefreplace')
+
+def set_attributes(tag, attrs, changes):
+    "the tag's bytes with attributes replaced or added, changes are escaped values"
+    def attribute(n):
+        return b'%s="%s"' % (n.encode('ascii'), changes[n].replace(b'"', b'&quot;'))
+    old = sorted((attrs[n][0], n) for n in changes if n in attrs)
+    for (start, end), n in reversed(old):
+        tag = tag[:start] + attribute(n) + tag[end:]
+    end = len(tag) - 1
+    if tag[end-1:end] == b'/':
+        end -= 1
+    while tag[end-1:end].isspace():
+        end -= 1
+    new = b''.join(b' ' + attribute(n) for n in sorted(changes) if n not in attrs)
+    return tag[:end] + new + tag[end:]
+
+def url_path(url):
+    "a url without its query and fragment"
+    return re.split('[?#]', url, 1)[0]
+
+def url_name(names, base_path, url):
+    "zip name a relative url points to, None for anything outside the zip"
+    path = url_path(url.strip())
+    if not path or path.startswith('/') or scheme_re.match(path):
+        return None
+    try:
+        n = smart_join(base_path, path)
+        if n not in names:
+            # file names with spaces and such are usually quoted
+            unquoted = smart_join(base_path, urllib.parse.unquote(path))
+            if unquoted in names:
+                n = unquoted
+    except Exception:
+        # goes above the root of the zip
+        return None
+    return n
+
+def is_svg(url, mime):
+    return splitext(url_path(url))[1].lower() == '.svg' or 'svg' in (mime or '')
+
+def tag_resources(kind, attrs):
+    """[(attribute, what)] a start tag could have inlined, what is
+    'img', 'image', 'srcset', 'svg', 'stylesheet' or 'style'"""
+    found = []
+    def has(n):
+        return attrs.get(n, (None, None, None))[2] is not None
+    if kind == 'img' and has('src'):
+        found.append(('src', 'img'))
+    if kind in ('img', 'source') and has('srcset'):
+        found.append(('srcset', 'srcset'))
+    if kind == 'input' and has('src') and (attrs.get('type')[2] if has('type') else '').lower() == 'image':
+        found.append(('src', 'image'))
+    if kind == 'object' and has('data') and is_svg(attrs['data'][2], has('type') and attrs['type'][2]):
+        found.append(('data', 'svg'))
+    if kind == 'embed' and has('src') and is_svg(attrs['src'][2], has('type') and attrs['type'][2]):
+        found.append(('src', 'svg'))
+    if kind == 'link' and has('href') and has('rel'):
+        rel = attrs['rel'][2].lower().split()
+        # alternate stylesheets would turn on if they were inlined
+        if 'stylesheet' in rel and 'alternate' not in rel:
+            found.append(('href', 'stylesheet'))
+    if has('style'):
+        found.append(('style', 'style'))
+    return found
+
+def srcset_urls(value):
+    "(start, end) of each candidate url in a srcset"
+    pos = 0
+    while pos < len(value):
+        while value[pos:pos+1] in (b',', b' ', b'\t', b'\n', b'\r', b'\f'):
+            pos += 1
+        if pos >= len(value):
+            break
+        start = pos
+        while pos < len(value) and not value[pos:pos+1].isspace():
+            pos += 1
+        end = pos
+        # a trailing comma ends the candidate without descriptors
+        if value[end-1:end] == b',':
+            while value[end-1:end] == b',':
+                end -= 1
+            yield start, end
             continue
-        replaced.add(n)
-        b64 = encode_file(z, n)
-        image_data_uri(img, b64)
-    return str(soup), replaced
+        yield start, end
+        while pos < len(value) and value[pos:pos+1] != b',':
+            pos += 1
+
+def css_urls(css):
+    "(start, end) of each url() and @import in css bytes"
+    spans = []
+    for r in (url_re, import_re):
+        for m in r.finditer(css):
+            start, end = m.span(1)
+            if css[start:start+1] in (b'"', b"'"):
+                start, end = start + 1, end - 1
+            spans.append((start, end))
+    return sorted(spans)
+
+def css_url(raw, in_html):
+    "a url out of css, in_html for css in a style attribute"
+    if in_html:
+        return text(raw).strip('"\'')
+    return raw.decode('utf-8', 'replace').strip()
+
+def inlines_in_css(name):
+    "only images are inlined from css, fonts and imports stay links"
+    return splitext(name)[1].lower() in data_extensions
+
+def css_names(names, css, base_path, in_html=False):
+    "zip names of everything css refers to"
+    for start, end in css_urls(css):
+        n = url_name(names, base_path, css_url(css[start:end], in_html))
+        if n is not None:
+            yield n
+
+def copy_scripts(z, root_path, shared):
+    "the script tags that fill in repeated images"
+    tags = ''
+    if shared:
+        src = os.path.relpath(os.path.join(html_root(z), '_inlined.js'), root_path or '.')
+        tags += '<script src="%s"></script>' % html.escape(src)
+    tags += '<script>%s</script>' % copy_script
+    return tags.encode('ascii', 'xmlcharrefreplace')
+
+class Rewriter(object):
+    "inlines one page, tag by tag"
+    def __init__(self, z, name, to_skip, encoded, shared):
+        self.z = z
+        self.names = z.NameToInfo
+        self.to_skip = to_skip
+        self.encoded = encoded
+        self.shared = shared
+        self.root_path = dirname(name)
+        self.replaced = set()
+        self.first = {}  # image -> id of its first inlined use on this page
+        self.waiting = False  # images that need the copy script
+
+    def inlined(self, n):
+        "data uri for a zip name, None when it stays a file"
+        if n is None or n in self.to_skip or n not in self.names:
+            return None
+        self.replaced.add(n)
+        return self.encoded.uri(n, splitext(n)[1])
+
+    def img(self, attrs, changes):
+        n = url_name(self.names, self.root_path, attrs['src'][2])
+        if n is None or n in self.to_skip or n not in self.names:
+            return
+        self.replaced.add(n)
+        if n in self.shared:
+            changes.update({'src': blank_gif.encode('ascii'), 'data-inline': escaped(n)})
+            self.waiting = True
+            return
+        if dedupe and n in self.first:
+            changes.update({'src': blank_gif.encode('ascii'), 'data-inline': escaped(self.first[n])})
+            self.waiting = True
+            return
+        changes['src'] = self.inlined(n).encode('ascii')
+        if dedupe:
+            key = attrs.get('id', (None, None, None))[2]
+            if not key:
+                key = 'inline-%i' % len(self.first)
+                changes['id'] = escaped(key)
+            self.first[n] = key
+
+    def srcset(self, raw):
+        parts = []
+        pos = 0
+        for start, end in srcset_urls(raw):
+            uri = self.inlined(url_name(self.names, self.root_path, text(raw[start:end])))
+            if uri is None:
+                continue
+            parts.extend((raw[pos:start], uri.encode('ascii')))
+            pos = end
+        parts.append(raw[pos:])
+        return b''.join(parts)
+
+    def css(self, css, base_path, in_html=False):
+        "css with its images inlined, other relative urls rebased onto the page"
+        parts = []
+        pos = 0
+        for start, end in css_urls(css):
+            url = css_url(css[start:end], in_html)
+            n = url_name(self.names, base_path, url)
+            if n is None:
+                continue
+            new = None
+            if inlines_in_css(n):
+                new = self.inlined(n)
+            if new is None and base_path != self.root_path:
+                new = os.path.relpath(os.path.join(base_path, url), self.root_path or '.')
+                if in_html:
+                    new = html.escape(new)
+            if new is None:
+                continue
+            parts.extend((css[pos:start], new.encode('utf-8')))
+            pos = end
+        parts.append(css[pos:])
+        return b''.join(parts)
+
+    def stylesheet(self, attrs):
+        "a style element standing in for a linked stylesheet, or None"
+        n = url_name(self.names, self.root_path, attrs['href'][2])
+        if n is None or n in self.to_skip or n not in self.names:
+            return None
+        self.replaced.add(n)
+        css = self.css(self.z.read(n), dirname(n))
+        # only the closing tag could end the element early
+        css = css.replace(b'</', b'<\\/')
+        media = b''
+        if attrs.get('media', (None, None, None))[1]:
+            media = b' media="%s"' % attrs['media'][1].replace(b'"', b'&quot;')
+        return b'<style%s>\n%s\n</style>' % (media, css)
+
+    def tag(self, kind, data):
+        "a start tag with whatever it points at inlined"
+        if kind not in resource_tags and b'style' not in data.lower():
+            return data
+        attrs = attributes(data)
+        changes = {}
+        for a, what in tag_resources(kind, attrs):
+            if what == 'stylesheet':
+                style = self.stylesheet(attrs)
+                if style is not None:
+                    return style
+            elif what == 'img':
+                self.img(attrs, changes)
+            elif what in ('image', 'svg'):
+                uri = self.inlined(url_name(self.names, self.root_path, attrs[a][2]))
+                if uri is not None:
+                    changes[a] = uri.encode('ascii')
+            elif what == 'srcset':
+                new = self.srcset(attrs[a][1])
+                if new != attrs[a][1]:
+                    changes[a] = new
+            elif what == 'style':
+                new = self.css(attrs[a][1], self.root_path, True)
+                if new != attrs[a][1]:
+                    changes[a] = new
+        if not changes:
+            return data
+        return set_attributes(data, attrs, changes)
+
+    def style(self, data):
+        "a whole style element"
+        start = data.index(b'>') + 1
+        end = data.lower().rindex(b'</style')
+        return data[:start] + self.css(data[start:end], self.root_path) + data[end:]
+
+def rewrite(z, f, out, name, to_skip, images=None, encoded=None, shared=None):
+    "copies a page from f to out with its resources inlined, returns replaced_files"
+    if encoded is None:
+        encoded = Encoded(z, images)
+    shared = shared or set()
+    page = Rewriter(z, name, to_skip, encoded, shared)
+    for kind, data in tokens(f):
+        if kind == 'body end' and page.waiting:
+            out.write(copy_scripts(z, page.root_path, shared))
+            page.waiting = False
+        if kind == 'style':
+            data = page.style(data)
+        elif kind not in (None, 'body end'):
+            data = page.tag(kind, data)
+        out.write(data)
+    if page.waiting:
+        out.write(copy_scripts(z, page.root_path, shared))
+    return page.replaced
+
+def process_html(z, i, to_skip, images=None, encoded=None, shared=None):
+    "returns (new_html, replaced_files), the html is bytes in the page's own encoding"
+    out = io.BytesIO()
+    with z.open(i) as f:
+        replaced = rewrite(z, f, out, i.filename, to_skip, images, encoded, shared)
+    return out.getvalue(), replaced
+
+class Pages(object):
+    "the html pages of a zip, scanned once for what they could inline"
+    def __init__(self, z, images=None):
+        self.z = z
+        self.images = images or {}
+        self.names = z.NameToInfo
+        self.css_refs = {}
+        self.resources = {}
+        for i in find_html(z):
+            with z.open(i) as f:
+                self.resources[i.filename] = list(self.scan(f, i.filename))
+
+    def stylesheet(self, n):
+        "zip names a stylesheet refers to, each read once"
+        if n not in self.css_refs:
+            self.css_refs[n] = []
+            if n in self.names:
+                self.css_refs[n] = list(css_names(self.names, self.z.read(n), dirname(n)))
+        return self.css_refs[n]
+
+    def scan(self, f, name):
+        "(zip name, is an img src) of everything a page could inline"
+        base_path = dirname(name)
+        def named(url):
+            return url_name(self.names, base_path, url)
+        for kind, data in tokens(f):
+            if kind == 'style':
+                start = data.index(b'>') + 1
+                for n in css_names(self.names, data[start:], base_path):
+                    if inlines_in_css(n):
+                        yield n, False
+                continue
+            if kind in (None, 'body end'):
+                continue
+            if kind not in resource_tags and b'style' not in data.lower():
+                continue
+            attrs = attributes(data)
+            for a, what in tag_resources(kind, attrs):
+                raw, value = attrs[a][1:]
+                if what == 'srcset':
+                    found = [named(text(raw[s:e])) for s,e in srcset_urls(raw)]
+                elif what == 'style':
+                    found = [n for n in css_names(self.names, raw, base_path, True) if inlines_in_css(n)]
+                else:
+                    found = [named(value)]
+                for n in found:
+                    if n is None:
+                        continue
+                    yield n, what == 'img'
+                    if what == 'stylesheet':
+                        for n2 in self.stylesheet(n):
+                            if inlines_in_css(n2):
+                                yield n2, False
+
+    def refs(self, name):
+        "zip name of each image on a page that is not inlined yet"
+        for n, is_img in self.resources[name]:
+            if is_img:
+                yield n
+
+    def files_to_skip(self, limit=1e6):
+        "set of absolute zip names that exceed the limit size"
+        size = dict((i.filename, i.file_size) for i in self.z.infolist())
+        # judged on their optimized size
+        for n,(data,ext) in self.images.items():
+            size[n] = len(data)
+        total = dict((i.filename, 0) for i in self.z.infolist())
+        counted = set()
+        skip = set()
+        # ignore html files
+        for name in self.resources:
+            size.pop(name)
+            total.pop(name)
+        for name in self.resources:
+            for img_path, is_img in self.resources[name]:
+                if img_path not in size:
+                    print("    warning: missing %s" % img_path)
+                    #skip.add(img_path)
+                    continue
+                # deduped images only cost their size once
+                if dedupe and is_img:
+                    key = img_path if dedupe == 'book' else (name, img_path)
+                    if key in counted:
+                        continue
+                    counted.add(key)
+                total[img_path] += size[img_path]
+        skip.update(n for n,s in size.items() if s > limit)
+        skip.update(n for n,s in total.items() if s > limit)
+        return skip
+
+    def repeated(self):
+        "zip names referenced more than once, anywhere in the book"
+        seen = set()
+        repeats = set()
+        for name in self.resources:
+            for n, is_img in self.resources[name]:
+                if n in seen:
+                    repeats.add(n)
+                seen.add(n)
+        return repeats
+
+    def shared_images(self, to_skip):
+        "inlined images used by more than one page, for dedupe = 'book'"
+        pages = {}
+        for name in self.resources:
+            for n in self.refs(name):
+                if n not in to_skip:
+                    pages.setdefault(n, set()).add(name)
+        return set(n for n,p in pages.items() if len(p) > 1)
+
+    def still_used(self, replaced, to_skip):
+        "inlined files that a stylesheet staying in the zip still links to"
+        kept = [i.filename for i in self.z.infolist() if splitext(i.filename)[1].lower() == '.css'
+                and (i.filename not in replaced or i.filename in to_skip)]
+        used = set()
+        while kept:
+            for n in self.stylesheet(kept.pop()):
+                if n in used or n not in replaced:
+                    continue
+                used.add(n)
+                if splitext(n)[1].lower() == '.css':
+                    kept.append(n)
+        return used
+
+    def process(self, i, to_skip, encoded=None, shared=None):
+        "process_html() for one of the pages"
+        return process_html(self.z, i, to_skip, self.images, encoded, shared)
+
+# raw copies go through ZipFile internals, these were checked against the
+# zipfile of CPython 3.6 to 3.13; without them members are recompressed
+raw_module_parts = ('structFileHeader', 'sizeFileHeader', 'stringFileHeader',
+                    '_FH_SIGNATURE', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+raw_reader_parts = ('_lock', 'fp')
+raw_writer_parts = ('_lock', 'fp', '_seekable', '_writecheck', '_didModify',
+                    'start_dir', 'filelist', 'NameToInfo')
+
+def can_raw_copy(z1, z2):
+    return all(hasattr(zipfile, a) for a in raw_module_parts) and \
+           all(hasattr(z1, a) for a in raw_reader_parts) and \
+           all(hasattr(z2, a) for a in raw_writer_parts) and \
+           not getattr(z2, '_writing', False)
+
+def raw_member(z, i):
+    "a member's still-compressed bytes, read straight out of the archive"
+    with z._lock:
+        z.fp.seek(i.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, z.fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile('bad local header for %s' % i.filename)
+        z.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        return z.fp.read(i.compress_size)
+
+def raw_copy(z1, z2, i1, name=None):
+    "copies a member across without decompressing it, optionally renamed"
+    if name is None:
+        name = i1.filename
+    if i1.flag_bits & 0x1:
+        # encrypted, leave it to zipfile
+        z2.writestr(name, z1.open(i1).read())
+        return
+    i2 = zipfile.ZipInfo(name, i1.date_time)
+    i2.compress_type = i1.compress_type
+    i2.create_system = i1.create_system
+    i2.external_attr = i1.external_attr
+    if not can_raw_copy(z1, z2):
+        z2.writestr(i2, z1.read(i1))
+        return
+    data = raw_member(z1, i1)
+    # sizes go in the local header, so no data descriptor
+    i2.flag_bits = i1.flag_bits & ~0x08
+    i2.CRC = i1.CRC
+    i2.compress_size = i1.compress_size
+    i2.file_size = i1.file_size
+    # the same bookkeeping ZipFile.writestr() does
+    with z2._lock:
+        if z2._seekable:
+            z2.fp.seek(z2.start_dir)
+        i2.header_offset = z2.fp.tell()
+        z2._writecheck(i2)
+        z2._didModify = True
+        z2.fp.write(i2.FileHeader())
+        z2.fp.write(data)
+        z2.filelist.append(i2)
+        z2.NameToInfo[i2.filename] = i2
+        z2.start_dir = z2.fp.tell()
+
+def shrunk(images, n):
+    "optimized data for a member that keeps its name, or None"
+    if n in images and images[n][1] == splitext(n)[1].lower():
+        return images[n][0]
+    return None
 
 def zip_rename(z1, z2, i1, i2):
-    z2.writestr(i2, z1.open(i1).read())
+    raw_copy(z1, z2, i1, getattr(i2, 'filename', i2))
 
 def zip_copy(z1, z2, i):
-    z2.writestr(i, z1.open(i).read())
+    raw_copy(z1, z2, i)
 
-def main(zips):
-    for zipname in zips:
-        z2_name = basename(zipname)
-        if isfile(z2_name):
-            print("Skipping %s" % z2_name)
+def convert_zip(zipname, z2_name):
+    "writes the inlined version of zipname to z2_name"
+    with zf(zipname, 'r') as z1, zf(z2_name, 'w') as z2:
+        convert_members(z1, z2)
+
+def convert_members(z1, z2):
+    "fills z2 with the inlined version of z1"
+    images = optimize_images(z1)
+    pages = Pages(z1, images)
+    to_skip = pages.files_to_skip()
+    encoded = Encoded(z1, images, pages.repeated())
+    shared = set()
+    if dedupe == 'book':
+        shared = pages.shared_images(to_skip)
+    replaced = set()
+    # insert data URIs
+    for i in find_html(z1):
+        i2 = zipfile.ZipInfo(i.filename, i.date_time)
+        i2.compress_type = i.compress_type
+        i2.external_attr = i.external_attr
+        # streamed straight into the new zip, however big the page
+        with z1.open(i) as f, z2.open(i2, 'w') as out:
+            replaced |= rewrite(z1, f, out, i.filename, to_skip, images, encoded, shared)
+        replaced.add(i.filename)
+    replaced -= pages.still_used(replaced, to_skip)
+    if shared:
+        z2.writestr(*shared_script(z1, shared, encoded))
+    # add in non-uri files
+    for i in z1.infolist():
+        n = i.filename
+        if n in replaced and n not in to_skip:
             continue
-        print("Converting %s" % z2_name)
-        z1 = zf(zipname, 'r')
-        to_skip = files_to_skip(z1)
-        z2 = zf(z2_name, 'w')
-        replaced = set()
-        # insert data URIs
-        for i in find_html(z1):
-            html2, r2 = process_html(z1, i, to_skip)
-            replaced |= r2
-            #open('test.html', 'w').write(html2)
-            z2.writestr(i, html2)
-            replaced.add(i.filename)
-        # add in non-uri files
-        for i in z1.infolist():
-            n = i.filename
-            if n in to_skip:
-                zip_copy(z1, z2, i)
+        data = shrunk(images, n)
+        if data is not None:
+            z2.writestr(n, data)
+            continue
+        zip_copy(z1, z2, i)
+
+def publish(part, name):
+    "moves a finished file to name, never replacing anything already there"
+    try:
+        # unlike a rename, a link never replaces what another run put there
+        os.link(part, name)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        # no hard links on this filesystem (FAT, some network mounts)
+        pass
+    # claim the name first, then move over our own empty file
+    open(name, 'xb').close()
+    try:
+        os.replace(part, name)
+    except BaseException:
+        os.remove(name)
+        raise
+
+def stale_claim(name):
+    "an empty zipball left by a run that died between claiming and filling it"
+    # the claim is filled right away, and a real zip is never empty
+    return os.path.getsize(name) == 0 and time.time() - os.path.getmtime(name) > 60
+
+def file_mode():
+    "what a plain open() would give a new file, mkstemp() makes them private"
+    mask = os.umask(0)
+    os.umask(mask)
+    return 0o666 & ~mask
+
+def convert_one(zipname):
+    """(zipname, old size, new size, seconds, problem)
+    new size is None when the zipball already exists"""
+    z2_name = basename(zipname)
+    if isfile(z2_name):
+        if not stale_claim(z2_name):
+            return zipname, 0, None, 0, None
+        try:
+            os.remove(z2_name)
+        except FileNotFoundError:
+            pass
+    start = time.time()
+    fd, part = tempfile.mkstemp(prefix='.%s.' % z2_name, suffix='.part', dir=part_dir)
+    os.close(fd)
+    try:
+        convert_zip(zipname, part)
+        os.chmod(part, file_mode())
+        publish(part, z2_name)
+    except FileExistsError:
+        return zipname, 0, None, 0, None
+    except Exception as e:
+        return zipname, 0, None, time.time() - start, '%s: %s' % (type(e).__name__, e)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return zipname, os.path.getsize(zipname), os.path.getsize(z2_name), time.time() - start, None
+
+def init_worker(settings):
+    "pool processes get the settings from the command line"
+    global optimize, dedupe, part_dir
+    optimize, dedupe, part_dir = settings
+
+def percent(old, new):
+    if not old:
+        return 0.0
+    return 100.0 * (new - old) / old
+
+def summary(done, failed, skipped, seconds):
+    "done is a list of (old size, new size)"
+    print('%i converted, %i skipped, %i failed in %.1f seconds' % (len(done), skipped, failed, seconds))
+    if not done:
+        return
+    old = sum(a for a,b in done)
+    new = sum(b for a,b in done)
+    changes = [percent(a, b) for a,b in done]
+    print('Processed %.1f MB/minute of content' % (old / 1e6 / max(seconds, 1e-3) * 60))
+    print('Size %.1f MB -> %.1f MB (%+.1f%%)' % (old / 1e6, new / 1e6, percent(old, new)))
+    print('Change per zipball: average %+.1f%%, least %+.1f%%, most %+.1f%%' %
+          (sum(changes) / len(changes), min(changes), max(changes)))
+
+def pooled(zips):
+    "convert_one() results from the worker processes, as they finish"
+    todo = list(zips)
+    todo.reverse()
+    # zips that were running when a worker died, each is tried again on its own
+    caught = []
+    while todo or caught:
+        alone = bool(caught)
+        queue = [caught.pop()] if alone else todo
+        size = 1 if alone else workers
+        with concurrent.futures.ProcessPoolExecutor(size, initializer=init_worker,
+                initargs=((optimize, dedupe, part_dir),)) as pool:
+            jobs = {}
+            dead = False
+            while (queue and not dead) or jobs:
+                # only as many as there are workers, so a death takes few zips with it
+                while queue and not dead and len(jobs) < size:
+                    z = queue.pop()
+                    jobs[pool.submit(convert_one, z)] = z
+                finished, _ = concurrent.futures.wait(jobs, return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in finished:
+                    z = jobs.pop(job)
+                    if not isinstance(job.exception(), concurrent.futures.process.BrokenProcessPool):
+                        yield job.result()
+                        continue
+                    # the pool is gone, the rest of the queue waits for a new one
+                    dead = True
+                    if alone:
+                        yield z, 0, None, 0, 'a worker process died'
+                    else:
+                        caught.append(z)
+
+def main(zips):
+    global part_dir
+    start = time.time()
+    # dead workers leave their part files behind, this goes once the run is over
+    part_dir = tempfile.mkdtemp(prefix='.converting.', dir='.')
+    if workers > 1:
+        results = pooled(zips)
+    else:
+        results = map(convert_one, zips)
+    done = []
+    failed = 0
+    skipped = 0
+    try:
+        for zipname, old, new, seconds, problem in results:
+            z2_name = basename(zipname)
+            if problem:
+                print("Failed %s, %s" % (z2_name, problem))
+                failed += 1
                 continue
-            if n in replaced:
+            if new is None:
+                print("Skipping %s" % z2_name)
+                skipped += 1
                 continue
-            zip_copy(z1, z2, i)
-        z2.close()
+            print("Converted %s in %.1f seconds, %+.1f%% size" % (z2_name, seconds, percent(old, new)))
+            done.append((old, new))
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+        part_dir = '.'
+    summary(done, failed, skipped, time.time() - start)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        main(zips_to_process(sys.argv[1:]))
+    args = sys.argv[1:]
+    if '--optimize' in args:
+        args.remove('--optimize')
+        optimize = True
+    for a in list(args):
+        if a.startswith('--dedupe='):
+            args.remove(a)
+            dedupe = a.partition('=')[2]
+            if dedupe not in dedupe_modes:
+                print('--dedupe takes page or book, not %s' % dedupe)
+                sys.exit(1)
+        if a.startswith('--workers='):
+            args.remove(a)
+            try:
+                workers = int(a.partition('=')[2])
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print(help_string)
+                sys.exit(1)
+    if args:
+        main(zips_to_process(args))
     else:
         print(help_string)
 